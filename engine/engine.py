@@ -10,8 +10,15 @@ import torch.nn.functional as F
 import wandb
 from loguru import logger
 from tqdm import tqdm
-from utils.dataset import tokenize
-from utils.misc import AverageMeter, ProgressMeter, concat_all_gather, trainMetricGPU
+from utils.dataset import RawBatch, RefParams, normalize_image, tokenize
+from utils.misc import (
+    AverageMeter,
+    ProgressMeter,
+    concat_all_gather,
+    multi_scale_size,
+    scaled_input_size,
+    trainMetricGPU,
+)
 
 
 def train(
@@ -39,19 +46,45 @@ def train(
     time.sleep(2)
     end = time.time()
 
-    # size_list = [320, 352, 384, 416, 448, 480, 512]
-    # idx = np.random.choice(len(size_list))
-    # new_size = size_list[idx]
+    # multi-scale training: TRAIN.multi_scale sizes, a new one every
+    # iteration or every epoch (TRAIN.multi_scale_schedule)
+    size_list = args.get("multi_scale") or []
+    per_iteration = args.get("multi_scale_schedule", "iter") == "iter"
 
     for i, (image, text, target) in enumerate(train_loader):
         data_time.update(time.time() - end)
         # data
-        image = image.cuda(non_blocking=True)
         text = text.cuda(non_blocking=True)
-        target = target.cuda(non_blocking=True).unsqueeze(1)
-
-        # # multi-scale training
-        # image = F.interpolate(image, size=(new_size, new_size), mode='bilinear')
+        new_size = None
+        if size_list:
+            new_size = multi_scale_size(
+                size_list, epoch, i + 1 if per_iteration else 0, args.manual_seed or 0
+            )
+        if isinstance(image, RawBatch):
+            if new_size is not None:
+                # letterbox straight to the scaled size
+                image.input_size = scaled_input_size(
+                    image.input_size, new_size, args.input_size
+                )
+            # decoded batches from RefDataset(device_letterbox=True)
+            image, target = image.to("cuda", non_blocking=True).letterbox(
+                target.cuda(non_blocking=True)
+            )
+        else:
+            image = image.cuda(non_blocking=True)
+            target = target.cuda(non_blocking=True).unsqueeze(1)
+            # uint8 batches from RefDataset(device_normalize=True)
+            if image.dtype == torch.uint8:
+                image = normalize_image(image)
+            if target.dtype == torch.uint8:
+                target = target.float().div_(255.0)
+            # multi-scale training, CRIS resizes the target to the prediction
+            if new_size is not None:
+                shape = scaled_input_size(image.shape[-2:], new_size, args.input_size)
+                if shape != tuple(image.shape[-2:]):
+                    image = F.interpolate(
+                        image, size=shape, mode="bilinear", align_corners=False
+                    )
 
         # forward
         with amp.autocast():
@@ -97,6 +130,57 @@ def train(
     return iou_meter.val, loss_meter.val
 
 
+def val_ious(model, imgs, texts, param, dataset, args):
+    """Per-sample IoU of one validation batch, at the original image size."""
+    if imgs.dtype == torch.uint8:
+        imgs = normalize_image(imgs)
+    # inference
+    preds = model(imgs, texts)
+    preds = torch.sigmoid(preds)
+    if preds.shape[-2:] != imgs.shape[-2:]:
+        preds = F.interpolate(
+            preds, size=imgs.shape[-2:], mode="bicubic", align_corners=True
+        ).squeeze(1)
+    if isinstance(param, RefParams):
+        mats, sizes = param.inverse.numpy(), param.ori_size.numpy()
+        indices = param.index.tolist()
+        mask_dirs = [None] * len(preds)
+    else:
+        mats, sizes = param["inverse"], param["ori_size"]
+        # in-memory val sets carry the GT, see RefDataset.gt_mask
+        indices = param.get("index", [None] * len(preds))
+        mask_dirs = param["mask_dir"]
+    ious = []
+    # process one batch
+    for pred, mask_dir, mat, ori_size, index in zip(
+        preds, mask_dirs, mats, sizes, indices
+    ):
+        h, w = np.array(ori_size)
+        mat = np.array(mat)
+        pred = pred.cpu().numpy()
+        pred = cv2.warpAffine(
+            pred, mat, (w, h), flags=cv2.INTER_CUBIC, borderValue=0.0
+        )
+        pred = np.array(pred > 0.35)
+        if dataset.in_memory:
+            mask = dataset.gt_mask(int(index))
+        else:
+            if mask_dir is None:
+                mask_dir = dataset.mask_path(int(index))
+            mask = cv2.imread(mask_dir, flags=cv2.IMREAD_GRAYSCALE)
+            # resize
+            if args.resize:
+                mask = cv2.resize(mask, (224, 224))
+                mask = mask / 255.0
+        # iou
+
+        inter = np.logical_and(pred, mask)
+        union = np.logical_or(pred, mask)
+        iou = np.sum(inter) / (np.sum(union) + 1e-6)
+        ious.append(iou)
+    return ious
+
+
 @torch.inference_mode()
 def validate(val_loader, model, epoch, args, train_iou, train_loss):
     iou_list = []
@@ -106,35 +190,7 @@ def validate(val_loader, model, epoch, args, train_iou, train_loss):
         # data
         imgs = imgs.cuda(non_blocking=True)
         texts = texts.cuda(non_blocking=True)
-        # inference
-        preds = model(imgs, texts)
-        preds = torch.sigmoid(preds)
-        if preds.shape[-2:] != imgs.shape[-2:]:
-            preds = F.interpolate(
-                preds, size=imgs.shape[-2:], mode="bicubic", align_corners=True
-            ).squeeze(1)
-        # process one batch
-        for pred, mask_dir, mat, ori_size in zip(
-            preds, param["mask_dir"], param["inverse"], param["ori_size"]
-        ):
-            h, w = np.array(ori_size)
-            mat = np.array(mat)
-            pred = pred.cpu().numpy()
-            pred = cv2.warpAffine(
-                pred, mat, (w, h), flags=cv2.INTER_CUBIC, borderValue=0.0
-            )
-            pred = np.array(pred > 0.35)
-            mask = cv2.imread(mask_dir, flags=cv2.IMREAD_GRAYSCALE)
-            # resize
-            if args.resize:
-                mask = cv2.resize(mask, (224, 224))
-                mask = mask / 255.0
-            # iou
-
-            inter = np.logical_and(pred, mask)
-            union = np.logical_or(pred, mask)
-            iou = np.sum(inter) / (np.sum(union) + 1e-6)
-            iou_list.append(iou)
+        iou_list += val_ious(model, imgs, texts, param, val_loader.dataset, args)
     iou_list = np.stack(iou_list)
     iou_list = torch.from_numpy(iou_list).to(imgs.device)
     iou_list = concat_all_gather(iou_list)
@@ -155,6 +211,9 @@ def validate(val_loader, model, epoch, args, train_iou, train_loss):
     )
 
     logger.info(head + temp)
+    text_cache = model.module.text_cache
+    if text_cache is not None:
+        logger.info(text_cache.summary())
 
     if dist.get_rank() in [-1, 0]:
         wandb.log(
@@ -173,11 +232,29 @@ def inference(test_loader, model, args):
     iou_list = []
     tbar = tqdm(test_loader, desc="Inference:", ncols=100)
     model.eval()
+    # CRIS under DataParallel
+    net = getattr(model, "module", model)
     time.sleep(2)
     for img, param in tbar:
         # data
         img = img.cuda(non_blocking=True)
-        mask = cv2.imread(param["mask_dir"][0], flags=cv2.IMREAD_GRAYSCALE)
+        if img.dtype == torch.uint8:
+            img = normalize_image(img)
+        dataset = test_loader.dataset
+        if isinstance(param, RefParams):
+            # same layout as the default collate of the dict params
+            index = int(param.index[0])
+            mask_dir = dataset.mask_path(index)
+            param = {
+                "mask_name": [dataset.mask_name(index)],
+                "inverse": param.inverse.double(),
+                "ori_size": param.ori_size,
+                "sents": list(zip(*param.sents)),
+                "index": index,
+            }
+        else:
+            mask_dir = param["mask_dir"][0]
+        mask = cv2.imread(mask_dir, flags=cv2.IMREAD_GRAYSCALE)
 
         # resize
         h_, w_ = mask.shape
@@ -191,11 +268,15 @@ def inference(test_loader, model, args):
 
             img_name = "{}-img.jpg".format(seg_id)
             mask_name = "{}-mask.png".format(seg_id)
+            if "index" in param:
+                ori_img = dataset.original_image(param["index"])
+            else:
+                ori_img = param["ori_img"][0].cpu().numpy()
             if args.resize:
-                img_param = cv2.resize(param["ori_img"][0].cpu().numpy(), (h_, w_))
+                img_param = cv2.resize(ori_img, (h_, w_))
             cv2.imwrite(
                 filename=os.path.join(args.vis_dir, img_name),
-                img=param["ori_img"][0].cpu().numpy(),
+                img=ori_img,
             )
             if args.resize:
                 mask = cv2.resize(mask, (h_, w_))
@@ -213,18 +294,18 @@ def inference(test_loader, model, args):
             cv2.imwrite(
                 filename=output_filename, img=mask
             )
-        # multiple sentences
-        for sent in param["sents"]:
+        # multiple sentences: encode the image once, decode all of its
+        # sentences in one batch
+        text = tokenize([sent[0] for sent in param["sents"]], args.word_len, True)
+        text = text.cuda(non_blocking=True)
+        preds = torch.sigmoid(net.decode(net.encode_visual(img), text))
+        if preds.shape[-2:] != img.shape[-2:]:
+            preds = F.interpolate(
+                preds, size=img.shape[-2:], mode="bicubic", align_corners=True
+            )
+        for sent, pred in zip(param["sents"], preds):
             mask = mask / 255.0
-            text = tokenize(sent, args.word_len, True)
-            text = text.cuda(non_blocking=True)
-            # inference
-            pred = model(img, text)
-            pred = torch.sigmoid(pred)
-            if pred.shape[-2:] != img.shape[-2:]:
-                pred = F.interpolate(
-                    pred, size=img.shape[-2:], mode="bicubic", align_corners=True
-                ).squeeze()
+            pred = pred.squeeze()
             # process one sentence
             h, w = param["ori_size"].numpy()[0]
             mat = param["inverse"].numpy()[0]
@@ -272,5 +353,7 @@ def inference(test_loader, model, args):
     logger.info("IoU={:.2f}".format(100.0 * iou.item()))
     for k, v in prec.items():
         logger.info("{}: {:.2f}.".format(k, 100.0 * v))
+    if net.text_cache is not None:
+        logger.info(net.text_cache.summary())
 
     return iou.item(), prec
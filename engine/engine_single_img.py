@@ -50,6 +50,8 @@ def convert(img, mask=None):
 
 @torch.inference_mode()
 def inference(img_path, txt, model, args):
+    """Masks of one image for `txt`, a prompt (one mask) or a list of
+    prompts (a list of masks, decoded in one batch)."""
 
     model.eval()
     # data
@@ -87,22 +89,28 @@ def inference(img_path, txt, model, args):
     text = tokenize(txt, args.word_len, True)
     text = text.cuda(non_blocking=True)
 
-    # inference
-    pred = model(img, text)
+    # inference: the image is encoded once for all the prompts
+    net = getattr(model, "module", model)
+    preds = net.decode(net.encode_visual(img), text)
 
-    pred = torch.sigmoid(pred)
-    if pred.shape[-2:] != img.shape[-2:]:
-        pred = F.interpolate(
-            pred, size=img.shape[-2:], mode="bicubic", align_corners=True
-        ).squeeze()
-    # process one sentence
+    preds = torch.sigmoid(preds)
+    if preds.shape[-2:] != img.shape[-2:]:
+        preds = F.interpolate(
+            preds, size=img.shape[-2:], mode="bicubic", align_corners=True
+        )
+    # process each sentence
     h, w = param["ori_size"][0]
     mat = param["inverse"][0]
-    pred = pred.cpu().numpy()
-    pred = cv2.warpAffine(pred, mat, (w, h), flags=cv2.INTER_CUBIC, borderValue=0.0)
-    pred = np.array(pred > 0.35)
+    preds = preds.squeeze(1).cpu().numpy()
+    preds = [
+        np.array(
+            cv2.warpAffine(pred, mat, (w, h), flags=cv2.INTER_CUBIC, borderValue=0.0)
+            > 0.35
+        )
+        for pred in preds
+    ]
     # print(img.shape, pred.shape)
-    return send_img, txt, pred
+    return send_img, txt, preds[0] if isinstance(txt, str) else preds
     # # iou
     # inter = np.logical_and(pred, mask)
     # union = np.logical_or(pred, mask)
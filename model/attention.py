@@ -0,0 +1,123 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def attention_mask(attn_mask, key_padding_mask, dtype):
+    """
+    nn.MultiheadAttention masks as one F.scaled_dot_product_attention mask:
+    `attn_mask` [L, S] (additive, or bool with True = masked) and
+    `key_padding_mask` [B, S] (True = padding). Returns None, a bool mask
+    (True = attend) or an additive mask in `dtype`, broadcastable to
+    [B, heads, L, S].
+    """
+    if attn_mask is not None and attn_mask.dtype == torch.bool:
+        attn_mask = torch.zeros_like(attn_mask, dtype=dtype).masked_fill_(
+            attn_mask, float("-inf"))
+    if key_padding_mask is None:
+        return None if attn_mask is None else attn_mask.to(dtype)
+    padding = key_padding_mask.bool()[:, None, None, :]
+    if attn_mask is None:
+        return ~padding
+    return attn_mask.to(dtype).masked_fill(padding, float("-inf"))
+
+
+def multi_head_attention(q, k, v, num_heads, mask=None, dropout_p=0.0):
+    """
+    Heads of projected batch-first q [B, L, E] and k / v [B, S, E] through
+    F.scaled_dot_product_attention (flash / memory-efficient kernels where
+    available); returns [B, L, E] before the output projection.
+    """
+    B, L, E = q.shape
+    S = k.shape[1]
+    head_dim = E // num_heads
+    q = q.view(B, L, num_heads, head_dim).transpose(1, 2)
+    k = k.view(B, S, num_heads, head_dim).transpose(1, 2)
+    v = v.view(B, S, num_heads, head_dim).transpose(1, 2)
+    if mask is not None and mask.dtype != torch.bool and mask.dtype != q.dtype:
+        # e.g. float32 masks under autocast
+        mask = mask.to(q.dtype)
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                         dropout_p=dropout_p)
+    return out.transpose(1, 2).reshape(B, L, E)
+
+
+class MultiheadAttention(nn.Module):
+    """
+    Batch-first replacement of nn.MultiheadAttention (kdim = vdim =
+    embed_dim) on F.scaled_dot_product_attention.
+
+    Parameters keep the names of nn.MultiheadAttention (`in_proj_weight`,
+    `in_proj_bias`, `out_proj`), so CLIP weights and existing CRIS
+    checkpoints load unchanged; state dicts with separate
+    `q/k/v_proj_weight` are packed on load. Attention weights are never
+    materialized, the second output is always None.
+    """
+    def __init__(self, embed_dim, num_heads, dropout=0.0, bias=True):
+        super().__init__()
+        assert embed_dim % num_heads == 0, \
+            "embed_dim must be divisible by num_heads"
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim,
+                                                       embed_dim))
+        if bias:
+            self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        else:
+            self.register_parameter("in_proj_bias", None)
+        self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        # same initialization as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        if self.in_proj_bias is not None:
+            nn.init.constant_(self.in_proj_bias, 0.)
+            nn.init.constant_(self.out_proj.bias, 0.)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        names = [prefix + f"{s}_proj_weight" for s in ["q", "k", "v"]]
+        if prefix + "in_proj_weight" not in state_dict and all(
+                name in state_dict for name in names):
+            state_dict[prefix + "in_proj_weight"] = torch.cat(
+                [state_dict.pop(name) for name in names])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project(self, query, key, value):
+        """q, k, v projections, packed into one matmul when inputs match."""
+        E = self.embed_dim
+        w, b = self.in_proj_weight, self.in_proj_bias
+        bias = (lambda i, j: None) if b is None else (lambda i, j: b[i:j])
+        if query is key and key is value:
+            return F.linear(query, w, b).chunk(3, dim=-1)
+        if query is key:
+            q, k = F.linear(query, w[:2 * E], bias(0, 2 * E)).chunk(2, dim=-1)
+            return q, k, F.linear(value, w[2 * E:], bias(2 * E, 3 * E))
+        q = F.linear(query, w[:E], bias(0, E))
+        if key is value:
+            k, v = F.linear(key, w[E:], bias(E, 3 * E)).chunk(2, dim=-1)
+            return q, k, v
+        return (q, F.linear(key, w[E:2 * E], bias(E, 2 * E)),
+                F.linear(value, w[2 * E:], bias(2 * E, 3 * E)))
+
+    def forward(self,
+                query,
+                key,
+                value,
+                key_padding_mask=None,
+                need_weights=False,
+                attn_mask=None):
+        '''
+            query: b, L, E
+            key / value: b, S, E
+            key_padding_mask: b, S (True = padding)
+            attn_mask: L, S (additive, or bool with True = masked)
+        '''
+        assert not need_weights, "attention weights are not computed"
+        q, k, v = self.project(query, key, value)
+        mask = attention_mask(attn_mask, key_padding_mask, q.dtype)
+        out = multi_head_attention(
+            q, k, v, self.num_heads, mask,
+            self.dropout if self.training else 0.0)
+        return self.out_proj(out), None
@@ -0,0 +1,145 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+from loguru import logger
+
+
+class ConstantCache(object):
+    """
+    Per-module store of tensors that only depend on input shapes, dtypes and
+    devices (positional encodings, coordinate maps, attention masks), and
+    optionally on parameters.
+
+    `get(key, build, params)` returns the tensor built for `key`; callers put
+    the shape, dtype and device it depends on into the key. Entries derived
+    from `params` record their (version, device, dtype) and are rebuilt
+    after any in-place update (optimizer step, load_state_dict, `.to()`).
+    While one of them needs a gradient the value is built on every call, so
+    autograd still sees the parameter.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build, params=()):
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return build()
+        state = tuple((p._version, p.device, p.dtype) for p in params)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == state:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        # plain tensors even when first built under inference_mode (validate,
+        # inference): training steps may save them for backward
+        with torch.inference_mode(False), torch.no_grad():
+            value = build()
+        self.entries[key] = (state, value)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TextCache(object):
+    """
+    LRU of CLIP text features, `(word [L, D], state [D])` keyed by the
+    token ids of a prompt (padding dropped), for the closed prompt sets of
+    the p0..p9 templates.
+
+    Entries are valid for one set of text encoder weights: `validate(params)`
+    drops them all once a parameter is updated in place or replaced, and
+    `state_dict()` records a fingerprint of the weights so that a stale file
+    or checkpoint entry is ignored by `load_state_dict()`.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.params_state = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def validate(self, params):
+        state = tuple((p._version, p.data_ptr(), p.dtype) for p in params)
+        if state != self.params_state:
+            self.entries.clear()
+            self.params_state = state
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, word, state):
+        # plain (non-inference) copies: entries filled during evaluation
+        # are reused by training steps with a frozen text encoder
+        with torch.inference_mode(False):
+            entry = word.clone(), state.clone()
+        self.entries[key] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def summary(self):
+        lookups = max(self.hits + self.misses, 1)
+        return "text cache: {} / {} prompts, {} hits ({:.1f}%), {} misses, " \
+            "{} evictions".format(len(self), self.capacity, self.hits,
+                                  100.0 * self.hits / lookups, self.misses,
+                                  self.evictions)
+
+    @staticmethod
+    def fingerprint(params):
+        """Hash of the bytes, shapes and dtypes of `params`."""
+        h = hashlib.blake2b(digest_size=16)
+        for p in params:
+            p = p.detach().cpu().contiguous()
+            h.update("{}{}".format(p.dtype, tuple(p.shape)).encode("ascii"))
+            h.update(p.reshape(-1).view(torch.uint8).numpy().tobytes())
+        return h.hexdigest()
+
+    def state_dict(self, params):
+        return {
+            "fingerprint": self.fingerprint(params),
+            "keys": list(self.entries),
+            "word": [w.cpu() for w, _ in self.entries.values()],
+            "state": [s.cpu() for _, s in self.entries.values()],
+        }
+
+    def load_state_dict(self, state_dict, params):
+        """Fill the cache from `state_dict()`, unless it was computed with
+        other text encoder weights; returns the number of loaded prompts."""
+        if state_dict.get("fingerprint") != self.fingerprint(params):
+            logger.warning("text cache computed with other weights, ignored")
+            return 0
+        self.validate(params)
+        device = params[0].device
+        for key, word, state in zip(state_dict["keys"], state_dict["word"],
+                                    state_dict["state"]):
+            self.put(key, word.to(device), state.to(device))
+        return len(state_dict["keys"])
+
+    def save(self, path, params):
+        torch.save(self.state_dict(params), path)
+
+    def load(self, path, params):
+        return self.load_state_dict(torch.load(path, map_location="cpu"),
+                                    params)
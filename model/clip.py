@@ -6,6 +6,9 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
+from .attention import MultiheadAttention, multi_head_attention
+from .cache import ConstantCache
+
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -76,6 +79,8 @@ class AttentionPool2d(nn.Module):
         self.connect = nn.Sequential(
             nn.Conv2d(embed_dim, output_dim, 1, stride=1, bias=False),
             nn.BatchNorm2d(output_dim))
+        # positional_embedding resized per feature size
+        self.constants = ConstantCache()
 
     def resize_pos_embed(self, pos_embed, input_shpae):
         """Resize pos_embed weights.
@@ -107,37 +112,27 @@ class AttentionPool2d(nn.Module):
         # pos_embed = torch.cat((cls_token_weight, pos_embed_weight), dim=1)
         return pos_embed_weight.transpose(-2, -1)
 
+    def resized_pos_embed(self, H, W):
+        """`positional_embedding` resized to (H, W). Without gradient it is
+        cached per size until the parameter is modified in place."""
+        weight = self.positional_embedding
+        return self.constants.get(
+            (H, W),
+            lambda: self.resize_pos_embed(weight.unsqueeze(0), (H, W)),
+            params=(weight,))
+
     def forward(self, x):
         B, C, H, W = x.size()
         res = self.connect(x)
         x = x.reshape(B, C, -1)  # NC(HW)
         # x = torch.cat([x.mean(dim=-1, keepdim=True), x], dim=-1)  # NC(1+HW)
-        pos_embed = self.positional_embedding.unsqueeze(0)
-        pos_embed = self.resize_pos_embed(pos_embed, (H, W))  # NC(HW)
+        pos_embed = self.resized_pos_embed(H, W)  # NC(HW)
         x = x + pos_embed.to(x.dtype)  # NC(HW)
-        x = x.permute(2, 0, 1)  # (HW)NC
-        x, _ = F.multi_head_attention_forward(
-            query=x,
-            key=x,
-            value=x,
-            embed_dim_to_check=x.shape[-1],
-            num_heads=self.num_heads,
-            q_proj_weight=self.q_proj.weight,
-            k_proj_weight=self.k_proj.weight,
-            v_proj_weight=self.v_proj.weight,
-            in_proj_weight=None,
-            in_proj_bias=torch.cat(
-                [self.q_proj.bias, self.k_proj.bias, self.v_proj.bias]),
-            bias_k=None,
-            bias_v=None,
-            add_zero_attn=False,
-            dropout_p=0,
-            out_proj_weight=self.c_proj.weight,
-            out_proj_bias=self.c_proj.bias,
-            use_separate_proj_weight=True,
-            training=self.training,
-            need_weights=False)
-        x = x.permute(1, 2, 0).reshape(B, -1, H, W)
+        x = x.transpose(1, 2)  # N(HW)C
+        x = multi_head_attention(self.q_proj(x), self.k_proj(x),
+                                 self.v_proj(x), self.num_heads)
+        x = self.c_proj(x)
+        x = x.transpose(1, 2).reshape(B, -1, H, W)
         x = x + res
         x = F.relu(x, True)
 
@@ -243,21 +238,23 @@ class ResidualAttentionBlock(nn.Module):
                  attn_mask: torch.Tensor = None):
         super().__init__()
 
-        self.attn = nn.MultiheadAttention(d_model, n_head)
+        # batch first, F.scaled_dot_product_attention
+        self.attn = MultiheadAttention(d_model, n_head)
         self.ln_1 = LayerNorm(d_model)
         self.mlp = nn.Sequential(
             OrderedDict([("c_fc", nn.Linear(d_model, d_model * 4)),
                          ("gelu", QuickGELU()),
                          ("c_proj", nn.Linear(d_model * 4, d_model))]))
         self.ln_2 = LayerNorm(d_model)
-        self.attn_mask = attn_mask
+        # causal mask of the full context, cut to the input length on every
+        # call; a buffer, so it follows the module to its device
+        self.register_buffer('attn_mask', attn_mask, persistent=False)
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(
-            dtype=x.dtype,
-            device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False,
-                         attn_mask=self.attn_mask)[0]
+        attn_mask = self.attn_mask
+        if attn_mask is not None:
+            attn_mask = attn_mask[:x.shape[1], :x.shape[1]]
+        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
@@ -319,9 +316,7 @@ class VisionTransformer(nn.Module):
         x = x + self.positional_embedding.to(x.dtype)
         x = self.ln_pre(x)
 
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
-        x = x.permute(1, 0, 2)  # LND -> NLD
+        x = self.transformer(x)  # NLD
 
         # x = self.ln_post(x[:, 0, :])
         x = self.ln_post(x[:, 1:, :])
@@ -441,9 +436,7 @@ class CLIP(nn.Module):
             self.dtype)  # [batch_size, n_ctx, d_model]
 
         x = x + self.positional_embedding.type(self.dtype)[:x.size(1)]
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
-        x = x.permute(1, 0, 2)  # LND -> NLD
+        x = self.transformer(x)  # NLD
         x = self.ln_final(x).type(self.dtype)
 
         # x.shape = [batch_size, n_ctx, transformer.width]
@@ -482,12 +475,12 @@ def convert_weights(model: nn.Module):
             if l.bias is not None:
                 l.bias.data = l.bias.data.half()
 
-        if isinstance(l, nn.MultiheadAttention):
+        if isinstance(l, (nn.MultiheadAttention, MultiheadAttention)):
             for attr in [
                     *[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]],
                     "in_proj_bias", "bias_k", "bias_v"
             ]:
-                tensor = getattr(l, attr)
+                tensor = getattr(l, attr, None)
                 if tensor is not None:
                     tensor.data = tensor.data.half()
 
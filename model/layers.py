@@ -4,6 +4,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .attention import MultiheadAttention
+from .cache import ConstantCache
+
 
 def conv_layer(in_dim, out_dim, kernel_size=1, padding=0, stride=1):
     return nn.Sequential(
@@ -26,16 +29,22 @@ class CoordConv(nn.Module):
         super().__init__()
         self.conv1 = conv_layer(in_channels + 2, out_channels, kernel_size,
                                 padding, stride)
+        # 1, 2, h, w coordinate maps
+        self.constants = ConstantCache()
+
+    def coord_feat(self, h, w, device, dtype):
+        def build():
+            x_range = torch.linspace(-1, 1, w, device=device)
+            y_range = torch.linspace(-1, 1, h, device=device)
+            y, x = torch.meshgrid(y_range, x_range)
+            return torch.stack([x, y]).unsqueeze(0).to(dtype)
+
+        return self.constants.get((h, w, device, dtype), build)
 
     def add_coord(self, input):
         b, _, h, w = input.size()
-        x_range = torch.linspace(-1, 1, w, device=input.device)
-        y_range = torch.linspace(-1, 1, h, device=input.device)
-        y, x = torch.meshgrid(y_range, x_range)
-        y = y.expand([b, 1, -1, -1])
-        x = x.expand([b, 1, -1, -1])
-        coord_feat = torch.cat([x, y], 1)
-        input = torch.cat([input, coord_feat], 1)
+        coord_feat = self.coord_feat(h, w, input.device, input.dtype)
+        input = torch.cat([input, coord_feat.expand([b, -1, -1, -1])], 1)
         return input
 
     def forward(self, x):
@@ -102,6 +111,8 @@ class TransformerDecoder(nn.Module):
         self.num_layers = num_layers
         self.norm = nn.LayerNorm(d_model)
         self.return_intermediate = return_intermediate
+        # (vis_pos, txt_pos) on the device of the inputs
+        self.constants = ConstantCache()
 
     @staticmethod
     def pos1d(d_model, length):
@@ -151,6 +162,14 @@ class TransformerDecoder(nn.Module):
 
         return pe.reshape(-1, 1, height * width).permute(2, 1, 0)  # hw, 1, 512
 
+    def pos_embed(self, C, H, W, D, L, device, dtype):
+        """Batch-first (vis_pos, txt_pos) on `device`, built once per
+        shape."""
+        return self.constants.get(
+            (C, H, W, D, L, device, dtype),
+            lambda: (self.pos2d(C, H, W).transpose(0, 1).to(device, dtype),
+                     self.pos1d(D, L).transpose(0, 1).to(device, dtype)))
+
     def forward(self, vis, txt, pad_mask):
         '''
             vis: b, 512, h, w
@@ -159,24 +178,22 @@ class TransformerDecoder(nn.Module):
         '''
         B, C, H, W = vis.size()
         _, L, D = txt.size()
-        # position encoding
-        vis_pos = self.pos2d(C, H, W)
-        txt_pos = self.pos1d(D, L)
-        # reshape & permute
-        vis = vis.reshape(B, C, -1).permute(2, 0, 1)
-        txt = txt.permute(1, 0, 2)
+        # position encoding, cached per shape (e.g. multi-scale sizes)
+        vis_pos, txt_pos = self.pos_embed(C, H, W, D, L, vis.device, vis.dtype)
+        # b, 512, h, w -> b, HW, 512 (batch first, as txt)
+        vis = vis.reshape(B, C, -1).transpose(1, 2)
         # forward
         output = vis
         intermediate = []
         for layer in self.layers:
             output = layer(output, txt, vis_pos, txt_pos, pad_mask)
             if self.return_intermediate:
-                # HW, b, 512 -> b, 512, HW
-                intermediate.append(self.norm(output).permute(1, 2, 0))
+                # b, HW, 512 -> b, 512, HW
+                intermediate.append(self.norm(output).transpose(1, 2))
 
         if self.norm is not None:
-            # HW, b, 512 -> b, 512, HW
-            output = self.norm(output).permute(1, 2, 0)
+            # b, HW, 512 -> b, 512, HW
+            output = self.norm(output).transpose(1, 2)
             if self.return_intermediate:
                 intermediate.pop()
                 intermediate.append(output)
@@ -199,12 +216,11 @@ class TransformerDecoderLayer(nn.Module):
         self.self_attn_norm = nn.LayerNorm(d_model)
         self.cross_attn_norm = nn.LayerNorm(d_model)
         # Attention Layer
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
-        self.multihead_attn = nn.MultiheadAttention(d_model,
-                                                    nhead,
-                                                    dropout=dropout,
-                                                    kdim=d_model,
-                                                    vdim=d_model)
+        # batch first, F.scaled_dot_product_attention
+        self.self_attn = MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.multihead_attn = MultiheadAttention(d_model,
+                                                 nhead,
+                                                 dropout=dropout)
         # FFN
         self.ffn = nn.Sequential(nn.Linear(d_model, dim_feedforward),
                                  nn.ReLU(True), nn.Dropout(dropout),
@@ -219,14 +235,15 @@ class TransformerDecoderLayer(nn.Module):
         self.dropout3 = nn.Dropout(dropout)
 
     def with_pos_embed(self, tensor, pos):
-        return tensor if pos is None else tensor + pos.to(tensor.device)
+        # pos is already on the device, see TransformerDecoder.forward
+        return tensor if pos is None else tensor + pos
 
     def forward(self, vis, txt, vis_pos, txt_pos, pad_mask):
         '''
-            vis: 26*26, b, 512
-            txt: L, b, 512
-            vis_pos: 26*26, 1, 512
-            txt_pos: L, 1, 512
+            vis: b, 26*26, 512
+            txt: b, L, 512
+            vis_pos: 1, 26*26, 512
+            txt_pos: 1, L, 512
             pad_mask: b, L
         '''
         # Self-Attention
@@ -290,7 +307,7 @@ class FPN(nn.Module):
         f5 = self.norm_layer(f5 * state)
         # fusion 2: b, 512, 26, 26
         f4 = self.f2_v_proj(v4)
-        f5_ = F.interpolate(f5, scale_factor=2, mode='bilinear')
+        f5_ = F.interpolate(f5, size=f4.shape[-2:], mode='bilinear')
         f4 = self.f2_cat(torch.cat([f4, f5_], dim=1))
         # fusion 3: b, 256, 26, 26
         f3 = self.f3_v_proj(v3)
@@ -301,7 +318,7 @@ class FPN(nn.Module):
         fq4 = self.f4_proj4(f4)
         fq3 = self.f4_proj3(f3)
         # query
-        fq5 = F.interpolate(fq5, scale_factor=2, mode='bilinear')
+        fq5 = F.interpolate(fq5, size=fq4.shape[-2:], mode='bilinear')
         fq = torch.cat([fq3, fq4, fq5], dim=1)
         fq = self.aggr(fq)
         fq = self.coordconv(fq)
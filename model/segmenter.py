@@ -3,9 +3,27 @@ import torch.nn as nn
 import torch.nn.functional as F
 from model.clip import build_model
 
+from .cache import TextCache
 from .layers import FPN, Projector, TransformerDecoder
 
 
+def text_lengths(word):
+    """word: b, words -> b, prompt lengths in tokens"""
+    # last non-padding position: "!" is token 0 too, inside a prompt
+    position = torch.arange(1, word.size(1) + 1, device=word.device)
+    return ((word != 0) * position).amax(dim=1)
+
+
+def trim_text(word):
+    """
+    Cut the trailing padding (token 0) shared by every prompt of the batch:
+    word: b, words -> b, longest prompt. Outputs are unchanged, the causal
+    text transformer never looks past a token and the decoder masks padded
+    words anyway.
+    """
+    return word[:, :max(int(text_lengths(word).max()), 1)]
+
+
 class CRIS(nn.Module):
     def __init__(self, cfg):
         super().__init__()
@@ -30,22 +48,74 @@ class CRIS(nn.Module):
         )
         # Projector
         self.proj = Projector(cfg.word_dim, cfg.vis_dim // 2, 3)
+        # text features of repeated prompts, while the text encoder is frozen
+        text_cache = cfg.get("text_cache", 0)
+        self.text_cache = TextCache(text_cache) if text_cache else None
 
-    def forward(self, img, word, mask=None):
+    @property
+    def text_params(self):
+        """Parameters of the CLIP text encoder, which text_cache depends on."""
+        clip = self.backbone
+        return [clip.positional_embedding, clip.text_projection] + [
+            p for m in [clip.token_embedding, clip.transformer, clip.ln_final]
+            for p in m.parameters()
+        ]
+
+    def encode_text(self, word):
+        """
+        word: b, words (trimmed)
+        returns word: b, words, 1024 and state: b, 1024, repeated prompts
+        from text_cache; features of padded words are zeros there, the
+        decoder masks them
+        """
+        cache = self.text_cache
+        params = self.text_params
+        if cache is None or (torch.is_grad_enabled()
+                             and any(p.requires_grad for p in params)):
+            return self.backbone.encode_text(word)
+        cache.validate(params)
+        autocast = torch.is_autocast_enabled()
+        lengths = text_lengths(word).tolist()
+        keys = [(autocast, tuple(t[:n]))
+                for t, n in zip(word.tolist(), lengths)]
+        found = {key: cache.get(key) for key in dict.fromkeys(keys)}
+        missing = [i for i, key in enumerate(keys) if found[key] is None]
+        # each missing prompt once, its first row in the batch
+        missing = list({keys[i]: i for i in reversed(missing)}.values())
+        if missing:
+            x, state = self.backbone.encode_text(trim_text(word[missing]))
+            for j, i in enumerate(missing):
+                found[keys[i]] = cache.put(keys[i], x[j, :lengths[i]],
+                                           state[j])
+        entries = [found[key] for key in keys]
+        word = nn.utils.rnn.pad_sequence([w for w, _ in entries],
+                                         batch_first=True)
+        return word, torch.stack([s for _, s in entries])
+
+    def encode_visual(self, img):
         """
         img: b, 3, h, w
+        returns the backbone features (v3, v4, v5), reusable by `decode` for
+        any number of prompts
+        """
+        return self.backbone.encode_image(img)
+
+    def decode(self, vis, word):
+        """
+        vis: (v3, v4, v5) of b images, or of 1 image shared by all prompts
         word: b, words
-        word_mask: b, words
-        mask: b, 1, h, w
+        returns the logits b, 1, 104, 104
         """
+        # text cost follows the longest prompt rather than word_len
+        word = trim_text(word)
         # padding mask used in decoder
         pad_mask = torch.zeros_like(word).masked_fill_(word == 0, 1).bool()
 
-        # vis: C3 / C4 / C5
         # word: b, length, 1024
         # state: b, 1024
-        vis = self.backbone.encode_image(img)
-        word, state = self.backbone.encode_text(word)
+        word, state = self.encode_text(word)
+        # one image, K prompts: broadcast the visual features (no copy)
+        vis = [v.expand(word.size(0), -1, -1, -1) for v in vis]
 
         # b, 512, 26, 26 (C4)
         fq = self.neck(vis, state)
@@ -54,7 +124,17 @@ class CRIS(nn.Module):
         fq = fq.reshape(b, c, h, w)
 
         # b, 1, 104, 104
-        pred = self.proj(fq, state)
+        return self.proj(fq, state)
+
+    def forward(self, img, word, mask=None):
+        """
+        img: b, 3, h, w
+        word: b, words
+        word_mask: b, words
+        mask: b, 1, h, w
+        """
+        # vis: C3 / C4 / C5
+        pred = self.decode(self.encode_visual(img), word)
 
         if self.training:
             # resize mask
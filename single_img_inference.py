@@ -96,6 +96,11 @@ def get_inferer(model_path=None):
         )
 
     model.eval().cuda()
+    # on the device the prompts are served on
+    text_cache = model.module.text_cache
+    if text_cache is not None and "text_cache" in checkpoint:
+        n = text_cache.load_state_dict(checkpoint["text_cache"], model.module.text_params)
+        logger.info("=> loaded {} cached prompts from checkpoint".format(n))
 
     def infer(img_path, txt):
         return inference(img_path, txt, model, args)
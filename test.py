@@ -10,7 +10,7 @@ import utils.config as config
 from engine.engine import inference
 from loguru import logger
 from model import build_segmenter
-from utils.dataset import RefDataset
+from utils.dataset import RefDataset, collate_params
 from utils.misc import setup_logger
 
 warnings.filterwarnings("ignore")
@@ -65,9 +65,17 @@ def main():
         word_length=args.word_len,
         prompt_type=args.prompt_type,
         resize=args.resize,
+        backend=args.get("backend", "lmdb"),
+        device_normalize=args.get("device_normalize", False),
+        compact_params=args.get("compact_params", False),
     )
     test_loader = torch.utils.data.DataLoader(
-        test_data, batch_size=1, shuffle=False, num_workers=1, pin_memory=True
+        test_data,
+        batch_size=1,
+        shuffle=False,
+        num_workers=1,
+        pin_memory=True,
+        collate_fn=collate_params if test_data.compact_params else None,
     )
 
     # build model
@@ -82,6 +90,12 @@ def main():
         checkpoint = torch.load(args.model_dir)
         model.load_state_dict(checkpoint["state_dict"], strict=True)
         logger.info("=> loaded checkpoint '{}'".format(args.model_dir))
+        text_cache = model.module.text_cache
+        if text_cache is not None and "text_cache" in checkpoint:
+            n = text_cache.load_state_dict(
+                checkpoint["text_cache"], model.module.text_params
+            )
+            logger.info("=> loaded {} cached prompts from checkpoint".format(n))
     else:
         raise ValueError(
             "=> resume failed! no checkpoint found at '{}'. Please check args.resume again!".format(
@@ -89,9 +103,18 @@ def main():
             )
         )
 
+    text_cache = model.module.text_cache
+    text_cache_file = args.get("text_cache_file", None)
+    if text_cache is not None and text_cache_file and os.path.isfile(text_cache_file):
+        n = text_cache.load(text_cache_file, model.module.text_params)
+        logger.info("=> loaded {} cached prompts from '{}'".format(n, text_cache_file))
+
     # inference
     inference(test_loader, model, args)
 
+    if text_cache is not None and text_cache_file:
+        text_cache.save(text_cache_file, model.module.text_params)
+
 
 if __name__ == "__main__":
     main()
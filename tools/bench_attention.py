@@ -0,0 +1,95 @@
+import argparse
+import resource
+import subprocess
+import sys
+import time
+import warnings
+
+sys.path.append('./')
+warnings.filterwarnings("ignore")
+
+import numpy as np
+import torch
+from torch import nn
+from model.attention import MultiheadAttention
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='CPU latency and peak memory of decoder self-attention: '
+        'sequence-first nn.MultiheadAttention (attention weights returned, '
+        'permutes around it) vs the batch-first SDPA module')
+    parser.add_argument('--tokens', type=int, default=676,
+                        help='26x26 visual tokens of a 416 input')
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch threads, 0 keeps the default')
+    parser.add_argument('--variant', choices=['mha', 'sdpa'], default=None,
+                        help='run one variant in this process (internal)')
+    return parser.parse_args()
+
+
+def peak_rss():
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(args, variant, batch_size):
+    """(median latency, peak memory above the inputs) of one variant; peak
+    RSS only grows, so every (variant, batch size) gets its own process."""
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, args.tokens, args.dim)
+    if variant == 'mha':
+        attn = nn.MultiheadAttention(args.dim, args.heads).eval()
+
+        def forward():
+            # as TransformerDecoderLayer did: [HW, B, C] in and out
+            xs = x.permute(1, 0, 2)
+            return attn(xs, xs, value=xs)[0].permute(1, 0, 2)
+    else:
+        attn = MultiheadAttention(args.dim, args.heads).eval()
+
+        def forward():
+            return attn(x, x, value=x)[0]
+
+    times = []
+    with torch.inference_mode():
+        forward()
+        base = peak_rss()
+        for _ in range(args.iters):
+            start = time.perf_counter()
+            forward()
+            times.append(time.perf_counter() - start)
+    return np.median(times), peak_rss() - base
+
+
+def main():
+    args = get_parser()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.variant is not None:
+        latency, memory = run(args, args.variant, args.batch_sizes[0])
+        print(latency, memory)
+        return
+    print('#########################################')
+    for batch_size in args.batch_sizes:
+        results = {}
+        for variant in ['mha', 'sdpa']:
+            cmd = [sys.executable] + sys.argv + [
+                '--variant', variant, '--batch-sizes', str(batch_size)]
+            out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout.split()
+            results[variant] = float(out[-2]), float(out[-1])
+        (mha_t, mha_m), (sdpa_t, sdpa_m) = results['mha'], results['sdpa']
+        print('bs={:<3d} L={}: nn.MultiheadAttention {:8.2f} ms {:8.1f} MB  '
+              'SDPA {:8.2f} ms {:8.1f} MB  ({:.2f}x faster)'.format(
+                  batch_size, args.tokens, 1e3 * mha_t, mha_m / 2**20,
+                  1e3 * sdpa_t, sdpa_m / 2**20, mha_t / sdpa_t))
+    print('#########################################')
+
+
+if __name__ == '__main__':
+    main()
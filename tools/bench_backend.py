@@ -0,0 +1,61 @@
+import argparse
+import os.path as osp
+import sys
+import time
+import warnings
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.storage import build_backend
+
+warnings.filterwarnings("ignore")
+
+
+def bench(backend, order, decode):
+    nbytes = 0
+    start = time.perf_counter()
+    for i in order:
+        ref = backend.get(i)
+        img, mask = ref["img"], ref["mask"]
+        nbytes += len(img) + len(mask)
+        if decode:
+            cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+            cv2.imdecode(np.frombuffer(mask, np.uint8), cv2.IMREAD_GRAYSCALE)
+    return time.perf_counter() - start, nbytes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare read throughput of the lmdb and shard backends."
+    )
+    parser.add_argument("--lmdb", type=str, required=True, help="lmdb file.")
+    parser.add_argument("--shard", type=str, required=True, help="shard folder.")
+    parser.add_argument(
+        "--decode", action="store_true", help="also imdecode image and mask."
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    backends = [
+        ("lmdb", build_backend("lmdb", args.lmdb)),
+        ("shard", build_backend("shard", args.shard)),
+    ]
+    num = len(backends[0][1])
+    assert num == len(backends[1][1]), "lmdb and shard hold different splits"
+    orders = [
+        ("sequential", np.arange(num)),
+        ("random", np.random.RandomState(0).permutation(num)),
+    ]
+    print('#########################################')
+    for order_name, order in orders:
+        for name, backend in backends:
+            # first pass warms the page cache, the second one is measured
+            bench(backend, order, False)
+            elapsed, nbytes = bench(backend, order, args.decode)
+            print("{:10s} {:6s}: {:8.1f} records/s  {:7.1f} MB/s".format(
+                order_name, name, num / elapsed, nbytes / elapsed / 2**20))
+    print('#########################################')
@@ -0,0 +1,78 @@
+import argparse
+import os.path as osp
+import sys
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+warnings.filterwarnings("ignore")
+
+import utils.config as config
+from utils.dataset import RefDataset
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compare letterbox padding of square and aspect-ratio bucketed inputs."
+    )
+    parser.add_argument(
+        "--config", default="path to xxx.yaml", type=str, help="config file"
+    )
+    parser.add_argument("--split", type=str, default="train", choices=["train", "val"])
+    parser.add_argument(
+        "--opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="override some settings in the config.",
+    )
+    args = parser.parse_args()
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    return args, cfg
+
+
+def padding(image_sizes, input_sizes):
+    """Letterboxed pixels and padding pixels per sample."""
+    scale = np.minimum(
+        input_sizes[:, 0] / image_sizes[:, 0], input_sizes[:, 1] / image_sizes[:, 1]
+    )
+    content = (image_sizes[:, 0] * scale) * (image_sizes[:, 1] * scale)
+    total = input_sizes[:, 0] * input_sizes[:, 1]
+    return total, total - content
+
+
+def main():
+    args, cfg = get_parser()
+    dataset = RefDataset(
+        lmdb_dir=cfg[f"{args.split}_lmdb"],
+        mask_dir=cfg.mask_root,
+        dataset=cfg.dataset,
+        split=cfg[f"{args.split}_split"],
+        mode=args.split,
+        input_size=cfg.input_size,
+        word_length=cfg.word_len,
+        prompt_type=cfg.prompt_type,
+        resize=cfg.resize,
+        backend=cfg.get("backend", "lmdb"),
+        aspect_buckets=cfg.get("aspect_buckets") or True,
+    )
+    image_sizes = dataset.image_sizes.astype(np.float64)
+    square = np.tile(np.array(dataset.input_size, np.float64), (len(image_sizes), 1))
+    bucketed = np.array(
+        [dataset.sample_input_size(i) for i in range(len(image_sizes))], np.float64
+    )
+    print("#########################################")
+    counts = np.bincount(dataset.sample_buckets, minlength=len(dataset.bucket_shapes))
+    for (h, w), count in zip(dataset.bucket_shapes, counts):
+        print("bucket {:4d}x{:<4d}: {:7d} samples".format(h, w, count))
+    for name, input_sizes in [("square", square), ("bucketed", bucketed)]:
+        total, pad = padding(image_sizes, input_sizes)
+        print("{:8s}: {:8.1f} Mpx/epoch, {:5.1f}% padding".format(
+            name, total.sum() / 1e6, 100.0 * pad.sum() / total.sum()))
+    print("#########################################")
+
+
+if __name__ == "__main__":
+    main()
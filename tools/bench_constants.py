@@ -0,0 +1,95 @@
+import argparse
+import sys
+import time
+import warnings
+
+sys.path.append('./')
+warnings.filterwarnings("ignore")
+
+import numpy as np
+import torch
+from model.clip import AttentionPool2d
+from model.layers import CoordConv, TransformerDecoder
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Per-call cost of the shape-keyed constants (positional '
+        'encodings, coordinate maps, attention masks), rebuilt vs cached')
+    parser.add_argument('--input-size', type=int, default=416)
+    parser.add_argument('--word-len', type=int, default=17)
+    parser.add_argument('--iters', type=int, default=200,
+                        help='calls of the constant getters')
+    parser.add_argument('--forward-iters', type=int, default=3,
+                        help='calls of the full module forward')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--cpu', action='store_true')
+    return parser.parse_args()
+
+
+def build(args, batch_size, device):
+    """(name, module, inputs, constants) for every module holding a
+    ConstantCache; `constants()` is what the module's forward looks up."""
+    s, L = args.input_size, args.word_len
+    h, w = s // 16, s // 16
+    coord = CoordConv(512, 512, 3, 1)
+    decoder = TransformerDecoder(3, 512, 8, 2048, 0.1)
+    pool = AttentionPool2d(7, 2048, 32, 1024)
+    dtype = torch.float32
+    return [
+        ('CoordConv', coord, (torch.randn(batch_size, 512, h, w),),
+         lambda: coord.coord_feat(h, w, device, dtype)),
+        ('TransformerDecoder', decoder,
+         (torch.randn(batch_size, 512, h, w), torch.randn(batch_size, L, 512),
+          torch.zeros(batch_size, L, dtype=torch.bool)),
+         lambda: decoder.pos_embed(512, h, w, 512, L, device, dtype)),
+        ('AttentionPool2d', pool, (torch.randn(batch_size, 2048, h // 2, w // 2),),
+         lambda: pool.resized_pos_embed(h // 2, w // 2)),
+    ]
+
+
+def clear(module):
+    for m in module.modules():
+        if hasattr(m, 'constants'):
+            m.constants.clear()
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    args = get_parser()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    print('#########################################')
+    for batch_size in args.batch_sizes:
+        # modules are built outside inference mode, as in train / test
+        for name, module, inputs, constants in build(args, batch_size, device):
+            module = module.to(device).eval()
+            inputs = [x.to(device) for x in inputs]
+            with torch.inference_mode():
+                rebuilt, cached = [], []
+                for _ in range(args.iters):
+                    clear(module)
+                    rebuilt.append(timed(constants, device))
+                    cached.append(timed(constants, device))
+                forward = min(timed(lambda: module(*inputs), device)
+                              for _ in range(args.forward_iters))
+            rebuilt, cached = np.median(rebuilt), np.median(cached)
+            print('bs={:<3d} {:24s}: {:8.3f} ms rebuilt  {:6.3f} ms cached  '
+                  '{:9.2f} ms forward ({:.1f}% saved, {})'.format(
+                      batch_size, name, 1e3 * rebuilt, 1e3 * cached,
+                      1e3 * forward, 100.0 * (rebuilt - cached) / forward,
+                      device))
+    print('#########################################')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import glob
+import os.path as osp
+import sys
+import time
+import warnings
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.dataset import jpeg_size, reduced_flags
+
+warnings.filterwarnings("ignore")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare full and reduced-resolution JPEG decode time and memory."
+    )
+    parser.add_argument("img_dir", type=str, help="folder of source .jpg images.")
+    parser.add_argument("--input-size", type=int, default=416)
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def reduce_factor(img_size, input_size):
+    scale = min(input_size / img_size[0], input_size / img_size[1])
+    for factor in (8, 4, 2):
+        if factor * scale <= 1:
+            return factor
+    return 1
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    files = sorted(glob.glob(osp.join(args.img_dir, "**", "*.jp*g"), recursive=True))
+    blobs, factors = [], []
+    for path in files[: args.limit]:
+        with open(path, "rb") as f:
+            buf = np.frombuffer(f.read(), np.uint8)
+        img_size = jpeg_size(buf)
+        if img_size is None:
+            continue
+        blobs.append(buf)
+        factors.append(reduce_factor(img_size, args.input_size))
+    print("{} images, reduction factors {}".format(
+        len(blobs), {f: factors.count(f) for f in sorted(set(factors))}))
+
+    print('#########################################')
+    for name, reduced in [("full", False), ("reduced", True)]:
+        pixels = 0
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for buf, factor in zip(blobs, factors):
+                flag = reduced_flags[factor] if reduced and factor > 1 else cv2.IMREAD_COLOR
+                pixels += cv2.imdecode(buf, flag).nbytes
+        count = args.repeat * max(len(blobs), 1)
+        elapsed = (time.perf_counter() - start) / count
+        print("{:8s}: {:7.2f} ms/decode  {:7.2f} MB/decoded image".format(
+            name, 1e3 * elapsed, pixels / count / 2**20))
+    print('#########################################')
@@ -0,0 +1,100 @@
+import argparse
+import os.path as osp
+import sys
+import time
+import warnings
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+warnings.filterwarnings("ignore")
+
+import utils.config as config
+from utils.dataset import RawBatch, RefDataset, collate_raw, normalize_image
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compare the per-sample OpenCV letterbox with the batched "
+        "grid_sample letterbox (on GPU, or CPU with --cpu)."
+    )
+    parser.add_argument(
+        "--config", default="path to xxx.yaml", type=str, help="config file"
+    )
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--cpu", action="store_true", help="letterbox on the CPU")
+    parser.add_argument(
+        "--opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="override some settings in the config.",
+    )
+    args = parser.parse_args()
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    return args, cfg
+
+
+def bench(dataset, batch_size, workers, batches, device):
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=workers,
+        pin_memory=device.type == "cuda",
+        drop_last=True,
+        collate_fn=collate_raw if dataset.device_letterbox else None,
+    )
+    count = 0
+    start = time.perf_counter()
+    for image, text, target in loader:
+        if isinstance(image, RawBatch):
+            image, target = image.to(device, non_blocking=True).letterbox(
+                target.to(device, non_blocking=True)
+            )
+        else:
+            image = normalize_image(image.to(device, non_blocking=True))
+            target = target.to(device, non_blocking=True).float().div_(255.0)
+        count += 1
+        if count == batches:
+            break
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / max(count, 1)
+
+
+def main():
+    args, cfg = get_parser()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device("cuda" if use_cuda else "cpu")
+    print("#########################################")
+    for name, device_letterbox in [("opencv", False), ("batched", True)]:
+        dataset = RefDataset(
+            lmdb_dir=cfg.train_lmdb,
+            mask_dir=cfg.mask_root,
+            dataset=cfg.dataset,
+            split=cfg.train_split,
+            mode="train",
+            input_size=cfg.input_size,
+            word_length=cfg.word_len,
+            prompt_type=cfg.prompt_type,
+            resize=cfg.resize,
+            backend=cfg.get("backend", "lmdb"),
+            reduced_decode=cfg.get("reduced_decode", False),
+            device_normalize=True,
+            target_stride=cfg.get("target_stride", 1),
+            device_letterbox=device_letterbox,
+            scale_range=cfg.get("scale_range") if device_letterbox else None,
+            flip=cfg.get("flip", False) and device_letterbox,
+        )
+        elapsed = bench(dataset, cfg.batch_size, args.workers, args.batches, device)
+        print("{:8s}: {:7.1f} ms/batch ({})".format(name, 1e3 * elapsed, device))
+        dataset.db.close()
+    print("#########################################")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import glob
+import os.path as osp
+import sys
+import time
+import warnings
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.record import decode_mask, encode_mask
+
+warnings.filterwarnings("ignore")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare PNG and compact binary mask size and decode time."
+    )
+    parser.add_argument("mask_dir", type=str, help="masks/<dataset> folder.")
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    files = sorted(glob.glob(osp.join(args.mask_dir, "**", "*.png"), recursive=True))
+    pngs, compacts = [], []
+    for path in files:
+        with open(path, "rb") as f:
+            png = f.read()
+        mask = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_GRAYSCALE)
+        compact = encode_mask(mask)
+        if compact is None:
+            continue
+        assert (decode_mask(compact) == mask).all(), path
+        pngs.append(png)
+        compacts.append(compact)
+    print("{} masks, {} binary".format(len(files), len(pngs)))
+
+    print('#########################################')
+    for name, blobs in [("png", pngs), ("compact", compacts)]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for blob in blobs:
+                decode_mask(blob)
+        elapsed = (time.perf_counter() - start) / (args.repeat * max(len(blobs), 1))
+        size = sum(len(blob) for blob in blobs) / max(len(blobs), 1)
+        print("{:8s}: {:9.1f} bytes/record  {:7.1f} us/decode".format(
+            name, size, 1e6 * elapsed))
+    print('#########################################')
@@ -0,0 +1,93 @@
+import argparse
+import sys
+import time
+import warnings
+
+sys.path.append('./')
+warnings.filterwarnings("ignore")
+
+import numpy as np
+import torch
+import utils.config as config
+from model import build_segmenter
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='K prompts on one image: K full forwards vs one '
+        'encode_visual and one batched decode')
+    parser.add_argument('--config',
+                        default='path to xxx.yaml',
+                        type=str,
+                        help='config file')
+    parser.add_argument('--prompts', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16], help='values of K')
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--opts',
+                        default=None,
+                        nargs=argparse.REMAINDER,
+                        help='override some settings in the config.')
+    args = parser.parse_args()
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    cfg.prompts, cfg.iters, cfg.cpu = args.prompts, args.iters, args.cpu
+    return cfg
+
+
+def median_time(fn, iters, device):
+    fn()  # warm-up
+    times = []
+    for _ in range(iters):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main():
+    args = get_parser()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    torch.manual_seed(0)
+    model, _ = build_segmenter(args)
+    model = model.to(device).eval()
+    img = torch.randn(1, 3, args.input_size, args.input_size, device=device)
+    print('#########################################')
+    with torch.inference_mode():
+        for K in args.prompts:
+            # prompts of 4 .. word_len tokens, padded
+            text = torch.zeros(K, args.word_len, dtype=torch.long)
+            for i in range(K):
+                n = np.random.randint(4, args.word_len + 1)
+                text[i, :n] = torch.randint(1, 49406, (n, ))
+                text[i, 0], text[i, n - 1] = 49406, 49407
+            text = text.to(device)
+
+            def loop():
+                return torch.cat([model(img, t[None]) for t in text])
+
+            def batched():
+                return model.decode(model.encode_visual(img), text)
+
+            # model/__init__.py allows reduced-precision float32 matmuls,
+            # compare the two paths at full precision
+            torch.set_float32_matmul_precision('highest')
+            err = (loop() - batched()).abs().max().item()
+            torch.set_float32_matmul_precision('medium')
+            t_loop = median_time(loop, args.iters, device)
+            t_batched = median_time(batched, args.iters, device)
+            print('K={:<3d}: {:8.2f} ms per-prompt forwards  {:8.2f} ms '
+                  'encode once + batched decode  ({:.2f}x, max abs diff '
+                  '{:.1e}, {})'.format(K, 1e3 * t_loop, 1e3 * t_batched,
+                                       t_loop / t_batched, err, device))
+    print('#########################################')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os.path as osp
+import sys
+import time
+import warnings
+
+import cv2
+import lmdb
+import numpy as np
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.record import loads_record, read_keys
+
+warnings.filterwarnings("ignore")
+
+
+def bench(path, num, decode, seed=0):
+    env = lmdb.open(
+        path,
+        subdir=osp.isdir(path),
+        readonly=True,
+        lock=False,
+        readahead=False,
+        meminit=False,
+    )
+    with env.begin(write=False, buffers=True) as txn:
+        keys = read_keys(txn)
+        order = np.random.RandomState(seed).randint(len(keys), size=num)
+        nbytes = 0
+        start = time.perf_counter()
+        for i in order:
+            buf = txn.get(keys[i])
+            ref = loads_record(buf)
+            img, mask = ref["img"], ref["mask"]
+            nbytes += len(buf)
+            if decode:
+                cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+                cv2.imdecode(np.frombuffer(mask, np.uint8), cv2.IMREAD_GRAYSCALE)
+        elapsed = time.perf_counter() - start
+    env.close()
+    return elapsed, nbytes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare record read speed of pyarrow and record LMDBs."
+    )
+    parser.add_argument("--old", type=str, required=True, help="pyarrow lmdb.")
+    parser.add_argument("--new", type=str, required=True, help="record lmdb.")
+    parser.add_argument("-n", "--num", type=int, default=2000, help="random reads.")
+    parser.add_argument(
+        "--decode", action="store_true", help="also imdecode image and mask."
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print('#########################################')
+    for name, path in [("pyarrow", args.old), ("record", args.new)]:
+        # warm the page cache so both formats are measured from memory
+        bench(path, args.num, False)
+        elapsed, nbytes = bench(path, args.num, args.decode)
+        print("{:8s}: {:8.1f} records/s  {:7.1f} us/record  {:7.1f} MB/s".format(
+            name, args.num / elapsed, 1e6 * elapsed / args.num,
+            nbytes / elapsed / 2**20))
+    print('#########################################')
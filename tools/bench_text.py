@@ -0,0 +1,115 @@
+import argparse
+import sys
+import time
+import warnings
+
+sys.path.append('./')
+warnings.filterwarnings("ignore")
+
+import numpy as np
+import torch
+from model.clip import CLIP
+from model.layers import TransformerDecoder
+from model.segmenter import trim_text
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Text-side latency (CLIP text transformer + decoder '
+        'cross-attention) per prompt length, padded to word_len vs trimmed '
+        'to the longest prompt of the batch')
+    parser.add_argument('--word-len', type=int, default=77)
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=[4, 8, 16, 32],
+                        help='prompt lengths in tokens, sot / eot included')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--input-size', type=int, default=416)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--cpu', action='store_true')
+    return parser.parse_args()
+
+
+def build(args):
+    """RN50 CLIP (text tower as in CRIS) and the CRIS decoder, random
+    weights."""
+    clip = CLIP(1024, args.input_size, (3, 4, 6, 3), 64, None, 77,
+                args.word_len, 49408, 512, 8, 12)
+    decoder = TransformerDecoder(3, 512, 8, 2048, 0.1)
+    return clip.eval(), decoder.eval()
+
+
+def prompts(batch_size, length, word_len):
+    """Padded tokens whose longest prompt has `length` tokens."""
+    word = torch.zeros(batch_size, word_len, dtype=torch.long)
+    for i in range(batch_size):
+        n = length if i == 0 else np.random.randint(2, length + 1)
+        word[i, 0] = 49406
+        word[i, 1:n - 1] = torch.randint(1, 49406, (n - 2, ))
+        word[i, n - 1] = 49407
+    return word
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, out
+
+
+def forward(clip, decoder, vis, word):
+    x, state = clip.encode_text(word)
+    return decoder(vis, x, word == 0), state
+
+
+def run(clip, decoder, vis, word, args, device):
+    """(text transformer s, decoder s)"""
+    text, dec = [], []
+    for _ in range(args.iters):
+        t, (x, _) = timed(lambda: clip.encode_text(word), device)
+        text.append(t)
+        pad_mask = word == 0
+        dec.append(timed(lambda: decoder(vis, x, pad_mask), device)[0])
+    return np.median(text), np.median(dec)
+
+
+def max_diff(clip, decoder, vis, word):
+    """Padded vs trimmed outputs, at full float32 matmul precision
+    (model/__init__.py allows reduced precision)."""
+    precision = torch.get_float32_matmul_precision()
+    torch.set_float32_matmul_precision('highest')
+    padded = forward(clip, decoder, vis, word)
+    trimmed = forward(clip, decoder, vis, trim_text(word))
+    torch.set_float32_matmul_precision(precision)
+    return max((a - b).abs().max().item() for a, b in zip(padded, trimmed))
+
+
+def main():
+    args = get_parser()
+    np.random.seed(0)
+    torch.manual_seed(0)
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    clip, decoder = build(args)
+    clip, decoder = clip.to(device), decoder.to(device)
+    s = args.input_size // 16
+    vis = torch.randn(args.batch_size, 512, s, s, device=device)
+    print('#########################################')
+    with torch.inference_mode():
+        for length in args.lengths:
+            word = prompts(args.batch_size, length, args.word_len).to(device)
+            padded = run(clip, decoder, vis, word, args, device)
+            trimmed = run(clip, decoder, vis, trim_text(word), args, device)
+            err = max_diff(clip, decoder, vis, word)
+            print('L={:<3d} text {:7.2f} -> {:7.2f} ms  decoder {:7.2f} -> '
+                  '{:7.2f} ms  (word_len {}, bs {}, max abs diff {:.1e}, '
+                  '{})'.format(length, 1e3 * padded[0], 1e3 * trimmed[0],
+                               1e3 * padded[1], 1e3 * trimmed[1],
+                               args.word_len, args.batch_size, err, device))
+    print('#########################################')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import sys
+import time
+import warnings
+
+sys.path.append('./')
+warnings.filterwarnings("ignore")
+
+import numpy as np
+import torch
+import utils.config as config
+from model import build_segmenter
+from model.cache import TextCache
+from model.segmenter import trim_text
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Text encoder cost of evaluation batches drawn from a '
+        'closed prompt set, without and with the text cache')
+    parser.add_argument('--config',
+                        default='path to xxx.yaml',
+                        type=str,
+                        help='config file')
+    parser.add_argument('--vocab', type=int, default=50,
+                        help='distinct prompts of the closed set')
+    parser.add_argument('--capacity', type=int, nargs='+',
+                        default=[16, 64], help='text cache sizes')
+    parser.add_argument('--batches', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--opts',
+                        default=None,
+                        nargs=argparse.REMAINDER,
+                        help='override some settings in the config.')
+    args = parser.parse_args()
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    for key in ['vocab', 'capacity', 'batches', 'batch_size', 'cpu']:
+        setattr(cfg, key, getattr(args, key))
+    return cfg
+
+
+def prompt_set(vocab, word_len):
+    """Padded token rows of `vocab` templated prompts (4 .. word_len
+    tokens)."""
+    rows = torch.zeros(vocab, word_len, dtype=torch.long)
+    for i in range(vocab):
+        n = np.random.randint(4, word_len + 1)
+        rows[i, :n] = torch.randint(1, 49406, (n, ))
+        rows[i, 0], rows[i, n - 1] = 49406, 49407
+    return rows
+
+
+def run(model, stream, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for word in stream:
+        model.encode_text(word)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    args = get_parser()
+    np.random.seed(0)
+    torch.manual_seed(0)
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    model, _ = build_segmenter(args)
+    model = model.to(device).eval()
+    rows = prompt_set(args.vocab, args.word_len)
+    # some prompts of a template set are far more frequent than others
+    freq = 1.0 / np.arange(1, args.vocab + 1)
+    # trimmed, as CRIS.decode passes them to encode_text
+    stream = [
+        trim_text(rows[np.random.choice(args.vocab, args.batch_size,
+                                        p=freq / freq.sum())]).to(device)
+        for _ in range(args.batches)
+    ]
+    print('#########################################')
+    with torch.inference_mode():
+        model.text_cache = None
+        run(model, stream[:2], device)  # warm-up
+        base = run(model, stream, device)
+        print('no cache        : {:8.2f} ms / batch ({})'.format(
+            1e3 * base / args.batches, device))
+        for capacity in args.capacity:
+            model.text_cache = TextCache(capacity)
+            t = run(model, stream, device)
+            print('cache size {:<5d}: {:8.2f} ms / batch ({:.2f}x), {}'.format(
+                capacity, 1e3 * t / args.batches, base / t,
+                model.text_cache.summary()))
+    print('#########################################')
+
+
+if __name__ == '__main__':
+    main()
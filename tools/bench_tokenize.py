@@ -0,0 +1,89 @@
+import argparse
+import json
+import os.path as osp
+import sys
+import time
+import warnings
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+import utils.dataset as dataset
+from utils.dataset import tokenize, tokenize_batch
+
+warnings.filterwarnings("ignore")
+
+
+def legacy_tokenize(texts, context_length=77, truncate=False):
+    """The row-by-row implementation `tokenize` replaced, kept for parity."""
+    if isinstance(texts, str):
+        texts = [texts]
+    _tokenizer = dataset._tokenizer
+    sot_token = _tokenizer.encoder["<|startoftext|>"]
+    eot_token = _tokenizer.encoder["<|endoftext|>"]
+    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
+    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+    for i, tokens in enumerate(all_tokens):
+        if len(tokens) > context_length:
+            if truncate:
+                tokens = tokens[:context_length]
+                tokens[-1] = eot_token
+            else:
+                raise RuntimeError(
+                    f"Input {texts[i]} is too long for context length {context_length}"
+                )
+        result[i, : len(tokens)] = torch.tensor(tokens)
+    return result
+
+
+def load_prompts(paths):
+    sents = []
+    for path in paths:
+        with open(path, "r") as f:
+            for item in json.load(f):
+                for prompt in item["prompts"].values():
+                    prompt = prompt if type(prompt) == list else [prompt]
+                    sents.extend(prompt if len(prompt) > 0 else [""])
+    return sents
+
+
+def timeit(fn, sents, epochs):
+    start = time.perf_counter()
+    for _ in range(epochs):
+        fn(sents)
+    return (time.perf_counter() - start) / (epochs * len(sents))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="tokenize() microbenchmark.")
+    parser.add_argument("json", nargs="+", type=str, help="anns/<dataset>/*.json")
+    parser.add_argument("--word-len", type=int, default=17)
+    parser.add_argument("--epochs", type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sents = load_prompts(args.json)
+    print("{} prompts, {} unique".format(len(sents), len(set(sents))))
+
+    new = tokenize_batch(sents, args.word_len, True)
+    old = legacy_tokenize(sents, args.word_len, True)
+    assert (torch.from_numpy(new) == old).all(), "tokenize_batch differs from legacy"
+
+    # warm the bpe caches the same way a worker does after its first epoch
+    legacy_tokenize(sents, args.word_len, True)
+    results = [
+        ("legacy, per prompt",
+         lambda s: [legacy_tokenize(t, args.word_len, True) for t in s]),
+        ("cached, per prompt",
+         lambda s: [tokenize(t, args.word_len, True) for t in s]),
+        ("cached, batch", lambda s: tokenize_batch(s, args.word_len, True)),
+    ]
+    print('#########################################')
+    for name, fn in results:
+        us = 1e6 * timeit(fn, sents, args.epochs)
+        print("{:20s}: {:8.2f} us/prompt".format(name, us))
+    print("prompt cache: {} rows, bpe cache: {} tokens".format(
+        len(dataset._prompt_cache), len(dataset._tokenizer.cache)))
+    print('#########################################')
@@ -0,0 +1,94 @@
+import argparse
+import os.path as osp
+import sys
+import time
+import warnings
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+warnings.filterwarnings("ignore")
+
+import utils.config as config
+from utils.dataset import RefDataset, normalize_image
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compare float32 and uint8 (device-normalized) training batches."
+    )
+    parser.add_argument(
+        "--config", default="path to xxx.yaml", type=str, help="config file"
+    )
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="override some settings in the config.",
+    )
+    args = parser.parse_args()
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    return args, cfg
+
+
+def bench(dataset, batch_size, workers, batches, device):
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=workers,
+        pin_memory=device.type == "cuda",
+        drop_last=True,
+    )
+    nbytes = count = 0
+    start = time.perf_counter()
+    for image, text, target in loader:
+        nbytes += image.nbytes + text.nbytes + target.nbytes
+        image = image.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        if image.dtype == torch.uint8:
+            image = normalize_image(image)
+        if target.dtype == torch.uint8:
+            target = target.float().div_(255.0)
+        count += 1
+        if count == batches:
+            break
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / max(count, 1), nbytes / max(count, 1)
+
+
+def main():
+    args, cfg = get_parser()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("#########################################")
+    for name, device_normalize in [("float32", False), ("uint8", True)]:
+        dataset = RefDataset(
+            lmdb_dir=cfg.train_lmdb,
+            mask_dir=cfg.mask_root,
+            dataset=cfg.dataset,
+            split=cfg.train_split,
+            mode="train",
+            input_size=cfg.input_size,
+            word_length=cfg.word_len,
+            prompt_type=cfg.prompt_type,
+            resize=cfg.resize,
+            backend=cfg.get("backend", "lmdb"),
+            device_normalize=device_normalize,
+            target_stride=cfg.get("target_stride", 1),
+        )
+        elapsed, nbytes = bench(
+            dataset, cfg.batch_size, args.workers, args.batches, device
+        )
+        print("{:8s}: {:8.2f} MB/batch  {:7.1f} ms/batch ({})".format(
+            name, nbytes / 2**20, 1e3 * elapsed, device))
+    print("#########################################")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import argparse
+import os.path as osp
+import sys
+import time
+import warnings
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+warnings.filterwarnings("ignore")
+
+import utils.config as config
+from utils.dataset import RefDataset, build_letterbox_cache
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Pre-letterbox a RefDataset split into a uint8 cache."
+    )
+    parser.add_argument(
+        "--config", default="path to xxx.yaml", type=str, help="config file"
+    )
+    parser.add_argument(
+        "--split",
+        default="train",
+        choices=["train", "val"],
+        type=str,
+        help="which split of the config to cache.",
+    )
+    parser.add_argument(
+        "-o", "--output-dir", required=True, type=str, help="the cache folder."
+    )
+    parser.add_argument(
+        "--opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="override some settings in the config.",
+    )
+    args = parser.parse_args()
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    return args, cfg
+
+
+def main():
+    args, cfg = get_parser()
+    dataset = RefDataset(
+        lmdb_dir=cfg["{}_lmdb".format(args.split)],
+        mask_dir=cfg.mask_root,
+        dataset=cfg.dataset,
+        split=cfg["{}_split".format(args.split)],
+        mode=args.split,
+        input_size=cfg.input_size,
+        word_length=cfg.word_len,
+        prompt_type=cfg.prompt_type,
+        resize=cfg.resize,
+        backend=cfg.get("backend", "lmdb"),
+        reduced_decode=cfg.get("reduced_decode", False),
+    )
+    print("Caching {} to {}".format(dataset, args.output_dir))
+    start = time.time()
+    n = build_letterbox_cache(dataset, args.output_dir)
+    print("Cached {} samples in {:.1f}s".format(n, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import os.path as osp
+import sys
+import warnings
+
+import lmdb
+from tqdm import tqdm
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.record import (
+    dumps_record,
+    is_record,
+    loads_pyarrow,
+    read_keys,
+    record_key,
+    write_index,
+)
+
+warnings.filterwarnings("ignore")
+
+
+def convert_lmdb(src_path, dst_path, write_frequency=1000):
+    """Rewrite a pyarrow-serialized LMDB into the record format."""
+    src = lmdb.open(
+        src_path,
+        subdir=osp.isdir(src_path),
+        readonly=True,
+        lock=False,
+        readahead=False,
+        meminit=False,
+    )
+    dst = lmdb.open(
+        dst_path,
+        subdir=False,
+        map_size=1099511627776 * 2,
+        readonly=False,
+        meminit=False,
+        map_async=True,
+    )
+    with src.begin(write=False, buffers=True) as rtxn:
+        keys = read_keys(rtxn)
+        txn = dst.begin(write=True)
+        for idx, key in enumerate(tqdm(keys, desc=osp.basename(src_path))):
+            buf = rtxn.get(key)
+            if is_record(buf):
+                record = bytes(buf)
+            else:
+                ref = loads_pyarrow(buf)
+                meta = {
+                    "mask_name": ref["mask_name"],
+                    "img_name": ref["img_name"],
+                    "prompts": ref["prompts"],
+                }
+                record = dumps_record(ref["img"], ref["mask"], meta)
+            txn.put(record_key(idx), record)
+            if idx % write_frequency == 0:
+                txn.commit()
+                txn = dst.begin(write=True)
+        txn.commit()
+    with dst.begin(write=True) as txn:
+        write_index(txn, len(keys))
+    dst.sync()
+    dst.close()
+    src.close()
+    return len(keys)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert pyarrow LMDBs to the record format."
+    )
+    parser.add_argument("lmdb", nargs="+", type=str, help="the lmdb files to convert.")
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        type=str,
+        required=True,
+        help="the folder of converted lmdb files, keeping the file names.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in args.lmdb:
+        dst_path = osp.join(args.output_dir, osp.basename(osp.normpath(path)))
+        assert osp.abspath(dst_path) != osp.abspath(path), "refusing to overwrite %s" % path
+        n = convert_lmdb(path, dst_path)
+        print("Converted %d records: %s -> %s" % (n, path, dst_path))
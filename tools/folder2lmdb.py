@@ -2,21 +2,34 @@ import argparse
 import json
 import os
 import os.path as osp
+import sys
+import threading
+import time
 import warnings
+from functools import partial
+from multiprocessing import Pool
+from queue import Full, Queue
 
+import cv2
 import lmdb
-import pyarrow as pa
+import numpy as np
 from tqdm import tqdm
 
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.dataset import tokenize_prompts
+from utils.record import (
+    BLOBS_KEY,
+    TOKS,
+    blob_key,
+    dumps_record,
+    encode_mask,
+    record_key,
+    write_index,
+)
+
 warnings.filterwarnings("ignore")
 
-
-def loads_pyarrow(buf):
-    """
-    Args:
-        buf: the output of `dumps`.
-    """
-    return pa.deserialize(buf)
+PROGRESS_KEY = b"__progress__"
 
 
 def raw_reader(path):
@@ -26,16 +39,95 @@ def raw_reader(path):
     return bin_data
 
 
-def dumps_pyarrow(obj):
-    """
-    Serialize an object.
-    Returns:
-        Implementation-dependent bytes-like object
+def encode_item(job, img_dir, mask_dir, word_len, compact_masks, dedup):
+    idx, item = job
+    img = raw_reader(osp.join(img_dir, item['img_name']))
+    mask = raw_reader(osp.join(mask_dir, item['mask_name']))
+    if compact_masks:
+        # binary masks as run lengths / packed bits, anything else stays a file
+        compact = encode_mask(
+            cv2.imdecode(np.frombuffer(mask, np.uint8), cv2.IMREAD_GRAYSCALE))
+        if compact is not None:
+            mask = compact
+    meta = {'mask_name': item['mask_name'], 'img_name': item['img_name'],
+            "prompts": item["prompts"]}  # edited
+    extra = None
+    if word_len:
+        # tokenize all prompt types once instead of in every __getitem__
+        meta["tokens"], tokens = tokenize_prompts(item["prompts"], word_len)
+        extra = {TOKS: tokens.tobytes()}
+    if dedup:
+        # the image goes to the blob store, the record only keeps its hash
+        key = blob_key(img)
+        return idx, dumps_record(None, mask, meta, extra, img_ref=key), (key, img)
+    return idx, dumps_record(img, mask, meta, extra), None
+
+
+def lmdb_writer(db, queue, write_frequency, stats, blobs=None):
+    """Own the write transaction: put records, checkpoint with `__progress__`.
+
+    With a blob store, images are put there first (skipping ones already
+    stored) and its transaction commits before the one of the records that
+    reference them. An exception (e.g. lmdb.MapFullError) is kept in
+    `stats["error"]` for the producer, see `put_job`.
     """
-    return pa.serialize(obj).to_buffer()
+    try:
+        write_records(db, queue, write_frequency, stats, blobs)
+    except BaseException as e:
+        stats["error"] = e
 
 
-def folder2lmdb(json_data, img_dir, mask_dir, output_dir, split, write_frequency=1000):
+def write_records(db, queue, write_frequency, stats, blobs):
+    txn = db.begin(write=True)
+    blob_txn = blobs.begin(write=True) if blobs is not None else None
+    pending = 0
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        idx, record, blob = job
+        if blob is not None:
+            key, img = blob
+            stats["images"] += 1
+            stats["image_bytes"] += len(img)
+            if blob_txn.put(key, img, overwrite=False):
+                stats["stored"] += 1
+                stats["stored_bytes"] += len(img)
+                stats["bytes"] += len(img)
+        txn.put(record_key(idx), record)
+        stats["bytes"] += len(record)
+        pending += 1
+        if pending == write_frequency:
+            if blob_txn is not None:
+                blob_txn.commit()
+                blob_txn = blobs.begin(write=True)
+            # records are written in order, so everything below idx + 1 is
+            # durable once this transaction commits
+            txn.put(PROGRESS_KEY, "{}".format(idx + 1).encode("ascii"))
+            txn.commit()
+            txn = db.begin(write=True)
+            pending = 0
+    if blob_txn is not None:
+        blob_txn.commit()
+    txn.commit()
+
+
+def put_job(queue, job, writer, stats):
+    """queue.put that raises the writer's error instead of blocking on a full
+    queue nobody drains anymore."""
+    while True:
+        if "error" in stats or not writer.is_alive():
+            raise RuntimeError("LMDB writer stopped") from stats.get("error")
+        try:
+            queue.put(job, timeout=1.0)
+            return
+        except Full:
+            pass
+
+
+def folder2lmdb(json_data, img_dir, mask_dir, output_dir, split,
+                write_frequency=1000, workers=None, word_len=17,
+                compact_masks=True, blob_store=None):
     lmdb_path = osp.join(output_dir, "%s.lmdb" % split)
     isdir = os.path.isdir(lmdb_path)
 
@@ -49,27 +141,74 @@ def folder2lmdb(json_data, img_dir, mask_dir, output_dir, split, write_frequency
         map_async=True,
     )
 
-    txn = db.begin(write=True)
-    tbar = tqdm(json_data)
-    for idx, item in enumerate(tbar):
-        img = raw_reader(osp.join(img_dir, item['img_name']))
-        mask = raw_reader(osp.join(mask_dir, item['mask_name']))
-        data = {'img': img, 'mask': mask,
-                'mask_name': item['mask_name'], 'img_name': item['img_name'],
-            "prompts": item["prompts"]}  # edited
-        txn.put(u'{}'.format(idx).encode('ascii'), dumps_pyarrow(data))
-        if idx % write_frequency == 0:
-            # print("[%d/%d]" % (idx, len(data_loader)))
-            txn.commit()
-            txn = db.begin(write=True)
+    # resume an interrupted build
+    with db.begin(write=False) as txn:
+        progress = txn.get(PROGRESS_KEY)
+    start = int(progress) if progress is not None else 0
+    if start > 0:
+        print("Resuming from record %d/%d" % (start, len(json_data)))
+
+    blobs = None
+    if blob_store is not None:
+        # content-addressed images shared with the other splits / datasets
+        print("Storing images in %s" % blob_store)
+        blobs = lmdb.open(
+            blob_store,
+            subdir=os.path.isdir(blob_store),
+            map_size=1099511627776 * 2,
+            readonly=False,
+            meminit=False,
+            map_async=True,
+        )
+
+    stats = {"bytes": 0, "images": 0, "image_bytes": 0, "stored": 0,
+             "stored_bytes": 0}
+    queue = Queue(maxsize=4 * write_frequency)
+    writer = threading.Thread(
+        target=lmdb_writer, args=(db, queue, write_frequency, stats, blobs)
+    )
+    writer.start()
+
+    jobs = [(idx, item) for idx, item in enumerate(json_data) if idx >= start]
+    encode = partial(encode_item, img_dir=img_dir, mask_dir=mask_dir,
+                     word_len=word_len, compact_masks=compact_masks,
+                     dedup=blobs is not None)
+    begin = time.time()
+    tbar = tqdm(total=len(json_data), initial=start)
+    with Pool(workers) as pool:
+        for idx, record, blob in pool.imap(encode, jobs, chunksize=16):
+            put_job(queue, (idx, record, blob), writer, stats)
+            tbar.update(1)
+            elapsed = max(time.time() - begin, 1e-6)
+            tbar.set_postfix_str("%.1f rec/s, %.1f MB/s" % (
+                (tbar.n - start) / elapsed, stats["bytes"] / elapsed / 2**20))
+    put_job(queue, None, writer, stats)
+    writer.join()
+    tbar.close()
+    if "error" in stats:
+        raise RuntimeError("LMDB writer stopped") from stats["error"]
 
     # finish iterating through dataset
-    txn.commit()
-    keys = ["{}".format(k).encode("ascii") for k in range(idx + 1)]
     with db.begin(write=True) as txn:
-        txn.put(b"__keys__", dumps_pyarrow(keys))
-        txn.put(b"__len__", dumps_pyarrow(len(keys)))
+        write_index(txn, len(json_data))
+        if blobs is not None:
+            txn.put(BLOBS_KEY, osp.relpath(
+                osp.abspath(blob_store), osp.dirname(osp.abspath(lmdb_path))
+            ).encode("utf-8"))
+        txn.delete(PROGRESS_KEY)
 
+    elapsed = max(time.time() - begin, 1e-6)
+    print("Wrote %d records in %.1fs: %.1f records/s, %.1f MB/s" % (
+        len(jobs), elapsed, len(jobs) / elapsed, stats["bytes"] / elapsed / 2**20))
+    if blobs is not None:
+        print("Dedup: %d images, %d new in the blob store (%.1f%% already "
+              "stored), %.1f of %.1f MB written" % (
+                  stats["images"], stats["stored"],
+                  100.0 * (stats["images"] - stats["stored"])
+                  / max(stats["images"], 1),
+                  stats["stored_bytes"] / 2**20, stats["image_bytes"] / 2**20))
+        blobs.sync()
+        blobs.close()
     print("Flushing database ...")
     db.sync()
     db.close()
@@ -96,6 +235,40 @@ def parse_args():
     parser.add_argument(
         "-s", "--split", type=str, default="train", help="the split type."
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="processes reading and encoding records (default: all cores).",
+    )
+    parser.add_argument(
+        "--write-frequency",
+        type=int,
+        default=1000,
+        help="records per transaction; progress is checkpointed at each commit.",
+    )
+    parser.add_argument(
+        "--word-len",
+        type=int,
+        default=17,
+        help="context length of the stored prompt tokens, match TRAIN.word_len "
+        "(0 disables pre-tokenization).",
+    )
+    parser.add_argument(
+        "--mask-format",
+        type=str,
+        default="compact",
+        choices=["compact", "file"],
+        help="store binary masks as run lengths / packed bits, or keep the files.",
+    )
+    parser.add_argument(
+        "--blob-store",
+        type=str,
+        default=None,
+        help="lmdb holding the images by content hash, shared by all splits and "
+        "datasets built with the same path (default: images inside the records).",
+    )
     args = parser.parse_args()
     return args
 
@@ -108,4 +281,8 @@ if __name__ == "__main__":
     with open(args.json_dir, "rb") as f:
         json_data = json.load(f)
 
-    folder2lmdb(json_data, args.img_dir, args.mask_dir, args.output_dir, args.split)
+    folder2lmdb(json_data, args.img_dir, args.mask_dir, args.output_dir, args.split,
+                write_frequency=args.write_frequency, workers=args.workers,
+                word_len=args.word_len,
+                compact_masks=args.mask_format == "compact",
+                blob_store=args.blob_store)
@@ -0,0 +1,40 @@
+import argparse
+import os
+import os.path as osp
+import sys
+import warnings
+
+from tqdm import tqdm
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.storage import LmdbBackend, write_shards
+
+warnings.filterwarnings("ignore")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert LMDBs to memory-mapped shard folders."
+    )
+    parser.add_argument("lmdb", nargs="+", type=str, help="the lmdb files to convert.")
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        type=str,
+        required=True,
+        help="the folder of shard folders, named after the lmdb files.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in args.lmdb:
+        src = LmdbBackend(path)
+        dst = osp.join(args.output_dir, osp.basename(osp.normpath(path)))
+        dst = osp.splitext(dst)[0] + ".shard"
+        records = (src.get(i) for i in tqdm(range(len(src)), desc=osp.basename(path)))
+        n = write_shards(records, dst)
+        print("Converted %d records: %s -> %s" % (n, path, dst))
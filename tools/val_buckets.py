@@ -0,0 +1,119 @@
+import argparse
+import os.path as osp
+import sys
+import warnings
+
+import numpy as np
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+warnings.filterwarnings("ignore")
+
+import utils.config as config
+from engine.engine import val_ious
+from model import build_segmenter
+from utils.dataset import RefDataset
+from utils.sampler import AspectRatioBatchSampler
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Validation IoU of a checkpoint on square inputs vs "
+        "aspect-ratio bucketed inputs."
+    )
+    parser.add_argument(
+        "--config", default="path to xxx.yaml", type=str, help="config file"
+    )
+    parser.add_argument(
+        "--resume", default=None, type=str, help="checkpoint, TRAIN.resume by default."
+    )
+    parser.add_argument("--cpu", action="store_true")
+    parser.add_argument(
+        "--opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="override some settings in the config.",
+    )
+    args = parser.parse_args()
+    cfg = config.load_cfg_from_cfg_file(args.config)
+    if args.opts is not None:
+        cfg = config.merge_cfg_from_list(cfg, args.opts)
+    return args, cfg
+
+
+def val_dataset(cfg, aspect_buckets):
+    return RefDataset(
+        lmdb_dir=cfg.val_lmdb,
+        mask_dir=cfg.mask_root,
+        dataset=cfg.dataset,
+        split=cfg.val_split,
+        mode="val",
+        input_size=cfg.input_size,
+        word_length=cfg.word_len,
+        prompt_type=cfg.prompt_type,
+        resize=cfg.resize,
+        backend=cfg.get("backend", "lmdb"),
+        aspect_buckets=aspect_buckets,
+    )
+
+
+@torch.inference_mode()
+def evaluate(model, loader, cfg, device):
+    ious = []
+    for imgs, texts, param in loader:
+        imgs = imgs.to(device, non_blocking=True)
+        texts = texts.to(device, non_blocking=True)
+        ious += val_ious(model, imgs, texts, param, loader.dataset, cfg)
+    # the datasets keep their LMDB open in this process, close it before
+    # the next one opens the same path
+    loader.dataset.db.close()
+    return np.array(ious)
+
+
+def summary(ious):
+    prec = "  ".join(
+        "Pr@{}: {:.2f}".format(thres * 10, 100.0 * (ious > thres / 10).mean())
+        for thres in range(5, 10)
+    )
+    return "IoU={:.2f}  {}".format(100.0 * ious.mean(), prec)
+
+
+def main():
+    args, cfg = get_parser()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device("cuda" if use_cuda else "cpu")
+    model, _ = build_segmenter(cfg)
+    # checkpoints hold the state dict of the wrapped model, as in test.py
+    model = torch.nn.DataParallel(model)
+    checkpoint = torch.load(args.resume or cfg.resume, map_location="cpu")
+    model.load_state_dict(checkpoint["state_dict"], strict=True)
+    model = model.module.to(device).eval()
+
+    square = val_dataset(cfg, None)
+    bucketed = val_dataset(cfg, cfg.get("aspect_buckets") or True)
+    loaders = [
+        ("square", torch.utils.data.DataLoader(
+            square, batch_size=cfg.batch_size_val, shuffle=False, num_workers=0
+        )),
+        ("bucketed", torch.utils.data.DataLoader(
+            bucketed,
+            batch_sampler=AspectRatioBatchSampler(
+                bucketed, cfg.batch_size_val, shuffle=False, drop_last=False,
+                num_replicas=1, rank=0,
+            ),
+            num_workers=0,
+        )),
+    ]
+    print("#########################################")
+    results = {}
+    for name, loader in loaders:
+        results[name] = evaluate(model, loader, cfg, device)
+        print("{:8s} ({} samples): {}".format(
+            name, len(results[name]), summary(results[name])))
+    print("IoU difference (bucketed - square): {:+.2f}".format(
+        100.0 * (results["bucketed"].mean() - results["square"].mean())))
+    print("#########################################")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import os.path as osp
+import sys
+import warnings
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from model.attention import MultiheadAttention
+from model.clip import AttentionPool2d, ResidualAttentionBlock
+from model.layers import TransformerDecoder
+
+warnings.filterwarnings("ignore")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check the scaled_dot_product_attention path against "
+        "nn.MultiheadAttention / F.multi_head_attention_forward.")
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def reference_mha(module, **kwargs):
+    """Sequence-first nn.MultiheadAttention loaded from `module`."""
+    ref = nn.MultiheadAttention(module.embed_dim, module.num_heads, **kwargs)
+    ref.load_state_dict(module.state_dict())
+    return ref.eval()
+
+
+def reference_decoder(decoder, vis, txt, pad_mask):
+    """The sequence-first TransformerDecoder forward, on nn.MultiheadAttention
+    copies of the decoder's attention weights."""
+    B, C, H, W = vis.size()
+    _, L, D = txt.size()
+    vis_pos = decoder.pos2d(C, H, W)
+    txt_pos = decoder.pos1d(D, L)
+    output = vis.reshape(B, C, -1).permute(2, 0, 1)
+    txt = txt.permute(1, 0, 2)
+    for layer in decoder.layers:
+        self_attn = reference_mha(layer.self_attn)
+        cross_attn = reference_mha(layer.multihead_attn)
+        vis2 = layer.norm1(output)
+        q = k = vis2 + vis_pos
+        vis2 = layer.self_attn_norm(self_attn(q, k, value=vis2)[0])
+        output = output + vis2
+        vis2 = layer.norm2(output)
+        vis2 = cross_attn(query=vis2 + vis_pos, key=txt + txt_pos, value=txt,
+                          key_padding_mask=pad_mask)[0]
+        output = output + layer.cross_attn_norm(vis2)
+        output = output + layer.ffn(layer.norm3(output))
+    return decoder.norm(output).permute(1, 2, 0)
+
+
+def reference_pool(pool, x):
+    """AttentionPool2d.forward on F.multi_head_attention_forward."""
+    B, C, H, W = x.size()
+    res = pool.connect(x)
+    x = x.reshape(B, C, -1)
+    x = x + pool.resized_pos_embed(H, W).to(x.dtype)
+    x = x.permute(2, 0, 1)
+    x, _ = F.multi_head_attention_forward(
+        query=x, key=x, value=x, embed_dim_to_check=x.shape[-1],
+        num_heads=pool.num_heads, q_proj_weight=pool.q_proj.weight,
+        k_proj_weight=pool.k_proj.weight, v_proj_weight=pool.v_proj.weight,
+        in_proj_weight=None,
+        in_proj_bias=torch.cat(
+            [pool.q_proj.bias, pool.k_proj.bias, pool.v_proj.bias]),
+        bias_k=None, bias_v=None, add_zero_attn=False, dropout_p=0,
+        out_proj_weight=pool.c_proj.weight, out_proj_bias=pool.c_proj.bias,
+        use_separate_proj_weight=True, training=False, need_weights=False)
+    x = x.permute(1, 2, 0).reshape(B, -1, H, W)
+    return F.relu(x + res, True)
+
+
+def check(name, actual, expected, atol):
+    err = (actual - expected).abs().max().item()
+    assert err <= atol, "{}: max abs error {:.2e} > {:.0e}".format(name, err, atol)
+    print("{:32s}: max abs error {:.2e}".format(name, err))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # model/__init__.py allows reduced-precision float32 matmuls, compare the
+    # attention paths themselves
+    torch.set_float32_matmul_precision("highest")
+    torch.manual_seed(args.seed)
+    B, L, S, E, H = 4, 676, 17, 512, 8
+    x = torch.randn(B, L, E)
+    y = torch.randn(B, S, E)
+    pad_mask = torch.zeros(B, S, dtype=torch.bool)
+    pad_mask[:, 10:] = True
+    causal = torch.empty(S, S).fill_(float("-inf")).triu_(1)
+
+    print("#########################################")
+    with torch.no_grad():
+        attn = MultiheadAttention(E, H).eval()
+        ref = reference_mha(attn)
+        xs, ys = x.transpose(0, 1), y.transpose(0, 1)
+        check("self-attention", attn(x, x, x)[0],
+              ref(xs, xs, xs)[0].transpose(0, 1), args.atol)
+        check("q = k != v", attn(x, x, 2 * x)[0],
+              ref(xs, xs, 2 * xs)[0].transpose(0, 1), args.atol)
+        check("cross-attention + padding", attn(x, y, y, pad_mask)[0],
+              ref(xs, ys, ys, pad_mask)[0].transpose(0, 1), args.atol)
+        check("causal float mask", attn(y, y, y, attn_mask=causal)[0],
+              ref(ys, ys, ys, attn_mask=causal)[0].transpose(0, 1), args.atol)
+        check("causal bool mask + padding",
+              attn(y, y, y, pad_mask, attn_mask=causal.isinf())[0],
+              ref(ys, ys, ys, pad_mask,
+                  attn_mask=causal.isinf())[0].transpose(0, 1), args.atol)
+
+        # existing checkpoints: nn.MultiheadAttention state dicts, packed
+        # and with separate q / k / v weights, load strictly
+        packed = nn.MultiheadAttention(E, H)
+        attn.load_state_dict(packed.state_dict())
+        check("packed checkpoint", attn(x, y, y)[0],
+              packed.eval()(xs, ys, ys)[0].transpose(0, 1), args.atol)
+        state = MultiheadAttention(E, H).state_dict()
+        weight = state.pop("in_proj_weight")
+        for s, w in zip(["q", "k", "v"], weight.chunk(3)):
+            state[f"{s}_proj_weight"] = w
+        attn.load_state_dict(state)
+        assert torch.equal(attn.in_proj_weight, weight)
+
+        decoder = TransformerDecoder(3, E, H, 2048, 0.1).eval()
+        vis = torch.randn(B, E, 26, 26)
+        check("TransformerDecoder (26x26)", decoder(vis, y, pad_mask),
+              reference_decoder(decoder, vis, y, pad_mask), args.atol)
+
+        block = ResidualAttentionBlock(E, H, causal).eval()
+        expected = block.ln_1(ys)
+        expected = reference_mha(block.attn)(
+            expected, expected, expected, need_weights=False,
+            attn_mask=causal)[0]
+        check("ResidualAttentionBlock (text)",
+              block.attention(block.ln_1(y)), expected.transpose(0, 1),
+              args.atol)
+
+        pool = AttentionPool2d(13, 2048, 32, 1024).eval()
+        feat = torch.randn(2, 2048, 13, 13)
+        check("AttentionPool2d", pool(feat), reference_pool(pool, feat),
+              args.atol)
+    print("#########################################")
@@ -0,0 +1,124 @@
+import argparse
+import gzip
+import json
+import os.path as osp
+import sys
+import time
+import warnings
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from utils.simple_tokenizer import (
+    SimpleTokenizer,
+    basic_clean,
+    bytes_to_unicode,
+    default_bpe,
+    get_pairs,
+    whitespace_clean,
+)
+
+warnings.filterwarnings("ignore")
+
+
+class ReferenceBPE(object):
+    """The original CLIP merge loop, kept to check `SimpleTokenizer.bpe_ids`."""
+
+    def __init__(self, bpe_path):
+        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+        merges = merges[1:49152-256-2+1]
+        merges = [tuple(merge.split()) for merge in merges]
+        self.bpe_ranks = dict(zip(merges, range(len(merges))))
+        self.merges = merges
+
+    def bpe(self, token):
+        word = tuple(token[:-1]) + (token[-1] + '</w>',)
+        pairs = get_pairs(word)
+        if not pairs:
+            return token + '</w>'
+        while True:
+            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            new_word = []
+            i = 0
+            while i < len(word):
+                try:
+                    j = word.index(first, i)
+                    new_word.extend(word[i:j])
+                    i = j
+                except ValueError:
+                    new_word.extend(word[i:])
+                    break
+                if word[i] == first and i < len(word)-1 and word[i+1] == second:
+                    new_word.append(first+second)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            word = tuple(new_word)
+            if len(word) == 1:
+                break
+            pairs = get_pairs(word)
+        return ' '.join(word)
+
+
+def vocab_tokens(reference):
+    """Every merged vocab entry as a pre-token, with and without `</w>`."""
+    tokens = set()
+    for first, second in reference.merges:
+        word = first + second
+        if word.endswith('</w>'):
+            tokens.add(word[:-len('</w>')])
+        else:
+            tokens.add(word)
+            tokens.add(word + 'x')
+    return sorted(t for t in tokens if t)
+
+
+def prompt_tokens(tokenizer, paths):
+    byte_encoder = bytes_to_unicode()
+    tokens = set()
+    for path in paths:
+        with open(path, "r") as f:
+            for item in json.load(f):
+                for prompt in item["prompts"].values():
+                    for sent in prompt if type(prompt) == list else [prompt]:
+                        text = whitespace_clean(basic_clean(sent)).lower()
+                        for token in tokenizer.pat.findall(text):
+                            tokens.add(''.join(byte_encoder[b] for b in token.encode('utf-8')))
+    return sorted(tokens)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check SimpleTokenizer BPE against the reference merge loop."
+    )
+    parser.add_argument("json", nargs="*", type=str, help="anns/<dataset>/*.json")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start = time.perf_counter()
+    tokenizer = SimpleTokenizer(merges_cache=None)
+    print("tokenizer startup (gzip): {:.1f} ms".format(1e3 * (time.perf_counter() - start)))
+    SimpleTokenizer()
+    start = time.perf_counter()
+    tokenizer = SimpleTokenizer()
+    print("tokenizer startup (cache): {:.1f} ms".format(1e3 * (time.perf_counter() - start)))
+
+    reference = ReferenceBPE(default_bpe())
+    tokenizer.cache_size = 0
+    for name, tokens in [("vocab", vocab_tokens(reference)),
+                         ("prompts", prompt_tokens(tokenizer, args.json))]:
+        timings = []
+        for fn in (reference.bpe, tokenizer.bpe):
+            start = time.perf_counter()
+            out = [fn(token) for token in tokens]
+            timings.append((time.perf_counter() - start, out))
+        (ref_time, expected), (new_time, actual) = timings
+        mismatches = [(t, e, a) for t, e, a in zip(tokens, expected, actual) if e != a]
+        assert not mismatches, "bpe mismatch on {}: {}".format(name, mismatches[:5])
+        print("{:8s}: {} tokens identical, reference {:.1f} us/token, new {:.1f} us/token".format(
+            name, len(tokens), 1e6 * ref_time / max(len(tokens), 1),
+            1e6 * new_time / max(len(tokens), 1)))
@@ -0,0 +1,80 @@
+import argparse
+import os.path as osp
+import sys
+import warnings
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+from model.clip import AttentionPool2d, Transformer
+from model.layers import CoordConv, TransformerDecoder
+
+warnings.filterwarnings("ignore")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Train, validate under inference_mode, train again on "
+        "the shapes first seen in validation: cached constants (masks, "
+        "positional encodings, coordinate maps) must stay usable by autograd, "
+        "as with TRAIN.train_clip: True.")
+    parser.add_argument("--cpu", action="store_true")
+    return parser.parse_args()
+
+
+def build(device):
+    """The modules holding cached constants, all trainable."""
+    mask = torch.empty(17, 17).fill_(float("-inf")).triu_(1)
+    return torch.nn.ModuleDict({
+        "text": Transformer(64, 2, 4, mask),
+        "coord": CoordConv(64, 64, 3, 1),
+        "decoder": TransformerDecoder(1, 64, 4, 128, 0.1),
+        "pool": AttentionPool2d(7, 64, 4, 32),
+    }).to(device)
+
+
+def step(modules, B, L, hw, device):
+    """Forward every module on a L-token text and hw x hw map, return the
+    summed loss."""
+    txt = modules["text"](torch.randn(B, L, 64, device=device))
+    vis = modules["coord"](torch.randn(B, 64, hw, hw, device=device))
+    pad_mask = torch.zeros(B, L, dtype=torch.bool, device=device)
+    out = modules["decoder"](vis, txt, pad_mask)
+    pool = modules["pool"](torch.randn(B, 64, hw, hw, device=device))
+    return txt.mean() + out.mean() + pool.mean()
+
+
+def inference_constants(modules):
+    """Names of cached constants that are inference tensors: autograd can
+    not save them, e.g. a GPU attention mask given to SDPA."""
+    found = []
+    for name, m in modules.named_modules():
+        if not hasattr(m, "constants"):
+            continue
+        for key, (_, value) in m.constants.entries.items():
+            values = value if isinstance(value, tuple) else (value, )
+            if any(v.is_inference() for v in values):
+                found.append("{} {}".format(name, key))
+    return found
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    device = torch.device("cuda" if use_cuda else "cpu")
+    torch.manual_seed(0)
+    modules = build(device)
+    print("#########################################")
+    modules.train()
+    step(modules, 2, 9, 13, device).backward()
+    print("train    L=9 13x13: ok")
+    modules.eval()
+    with torch.inference_mode():
+        step(modules, 2, 5, 11, device)
+    found = inference_constants(modules)
+    assert not found, "inference tensors cached: {}".format(found)
+    print("validate L=5 11x11: ok")
+    modules.train()
+    step(modules, 2, 5, 11, device).backward()
+    print("train    L=5 11x11: ok ({})".format(device))
+    print("#########################################")
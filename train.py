@@ -22,8 +22,16 @@ from engine.engine import train, validate
 from loguru import logger
 from model import build_segmenter
 from torch.optim.lr_scheduler import MultiStepLR
-from utils.dataset import RefDataset
+from utils.dataset import (
+    ConcatRefDataset,
+    RefDataset,
+    build_shared_cache,
+    collate_params,
+    collate_raw,
+    shared_cache_dir,
+)
 from utils.misc import init_random_seed, set_random_seed, setup_logger, worker_init_fn
+from utils.sampler import AspectRatioBatchSampler
 
 warnings.filterwarnings("ignore")
 cv2.setNumThreads(0)
@@ -62,6 +70,51 @@ def main():
     mp.spawn(main_worker, nprocs=args.ngpus_per_node, args=(args,))
 
 
+def build_dataset(args, split, **kwargs):
+    """
+    RefDataset of `split` ("train" or "val"), or a ConcatRefDataset when
+    DATA.sources lists several datasets (dataset, train_lmdb, val_lmdb,
+    mask_root and optional weight, train_cache, val_cache).
+    """
+    sources = args.get("sources") or [
+        {
+            "dataset": args.dataset,
+            "train_lmdb": args.train_lmdb,
+            "val_lmdb": args.val_lmdb,
+            "mask_root": args.mask_root,
+            "train_cache": args.get("train_cache"),
+            "val_cache": args.get("val_cache"),
+        }
+    ]
+    datasets = [
+        RefDataset(
+            lmdb_dir=source[f"{split}_lmdb"],
+            mask_dir=source["mask_root"],
+            dataset=source["dataset"],
+            split=args[f"{split}_split"],
+            mode=split,
+            input_size=args.input_size,
+            word_length=args.word_len,
+            prompt_type=args.prompt_type,
+            resize=args.resize,
+            cache_dir=source.get(f"{split}_cache"),
+            backend=args.get("backend", "lmdb"),
+            reduced_decode=args.get("reduced_decode", False),
+            device_normalize=args.get("device_normalize", False),
+            aspect_buckets=args.get("aspect_buckets"),
+            **kwargs,
+        )
+        for source in sources
+    ]
+    if not args.get("sources"):
+        return datasets[0]
+    # sampling weights only change how often training sees each source
+    weights = None
+    if split == "train":
+        weights = [source.get("weight", 1.0) for source in sources]
+    return ConcatRefDataset(datasets, weights, seed=args.manual_seed or 0)
+
+
 def main_worker(gpu, args):
     args.output_dir = os.path.join(args.output_folder, args.exp_name)
 
@@ -120,53 +173,82 @@ def main_worker(gpu, args):
     args.batch_size = int(args.batch_size / args.ngpus_per_node)
     args.batch_size_val = int(args.batch_size_val / args.ngpus_per_node)
     args.workers = int((args.workers + args.ngpus_per_node - 1) / args.ngpus_per_node)
-    train_data = RefDataset(
-        lmdb_dir=args.train_lmdb,
-        mask_dir=args.mask_root,
-        dataset=args.dataset,
-        split=args.train_split,
-        mode="train",
-        input_size=args.input_size,
-        word_length=args.word_len,
-        prompt_type=args.prompt_type,
-        resize=args.resize,
+    train_data = build_dataset(
+        args,
+        "train",
+        target_stride=args.get("target_stride", 1),
+        prefetch=args.get("prefetch", 0),
+        device_letterbox=args.get("device_letterbox", False),
+        scale_range=args.get("scale_range"),
+        flip=args.get("flip", False),
     )
-    val_data = RefDataset(
-        lmdb_dir=args.val_lmdb,
-        mask_dir=args.mask_root,
-        dataset=args.dataset,
-        split=args.val_split,
-        mode="val",
-        input_size=args.input_size,
-        word_length=args.word_len,
-        prompt_type=args.prompt_type,
-        resize=args.resize,
+    val_data = build_dataset(
+        args,
+        "val",
+        in_memory=args.get("val_in_memory", False),
+        compact_params=args.get("compact_params", False),
     )
 
+    # decode small splits once per node into /dev/shm, shared by all ranks
+    if args.get("shm_cache", False):
+        for split_data in (train_data, val_data):
+            # the members of a ConcatRefDataset are cached one by one
+            for dataset in getattr(split_data, "sources", [split_data]):
+                if (
+                    dataset.in_memory
+                    or dataset.aspect_buckets
+                    or dataset.device_letterbox
+                ):
+                    continue
+                if args.gpu == 0:
+                    build_shared_cache(dataset)
+                dist.barrier()
+                dataset.cache_dir = shared_cache_dir(dataset)
+
     # build dataloader
     init_fn = partial(
         worker_init_fn, num_workers=args.workers, rank=args.rank, seed=args.manual_seed
     )
-    train_sampler = data.distributed.DistributedSampler(train_data, shuffle=True)
-    val_sampler = data.distributed.DistributedSampler(val_data, shuffle=False)
+    if args.get("aspect_buckets"):
+        # one rectangular input size per batch, picked by the sampler
+        train_sampler = AspectRatioBatchSampler(
+            train_data, args.batch_size, shuffle=True, drop_last=True,
+            seed=args.manual_seed or 0,
+        )
+        val_sampler = AspectRatioBatchSampler(
+            val_data, args.batch_size_val, shuffle=False, drop_last=False
+        )
+        train_batching = {"batch_sampler": train_sampler}
+        val_batching = {"batch_sampler": val_sampler}
+    else:
+        train_sampler = data.distributed.DistributedSampler(train_data, shuffle=True)
+        val_sampler = data.distributed.DistributedSampler(val_data, shuffle=False)
+        train_batching = {
+            "batch_size": args.batch_size,
+            "sampler": train_sampler,
+            "drop_last": True,
+        }
+        val_batching = {
+            "batch_size": args.batch_size_val,
+            "sampler": val_sampler,
+            "drop_last": False,
+        }
     train_loader = data.DataLoader(
         train_data,
-        batch_size=args.batch_size,
         shuffle=False,
         num_workers=args.workers,
         pin_memory=True,
         worker_init_fn=init_fn,
-        sampler=train_sampler,
-        drop_last=True,
+        collate_fn=collate_raw if train_data.device_letterbox else None,
+        **train_batching,
     )
     val_loader = data.DataLoader(
         val_data,
-        batch_size=args.batch_size_val,
         shuffle=False,
         num_workers=args.workers_val,
         pin_memory=True,
-        sampler=val_sampler,
-        drop_last=False,
+        collate_fn=collate_params if val_data.compact_params else None,
+        **val_batching,
     )
 
     best_IoU = 0.0
@@ -181,6 +263,11 @@ def main_worker(gpu, args):
             args.start_epoch = checkpoint["epoch"]
             # best_IoU = checkpoint["best_iou"]
             model.load_state_dict(checkpoint["state_dict"])
+            text_cache = model.module.text_cache
+            if text_cache is not None and "text_cache" in checkpoint:
+                text_cache.load_state_dict(
+                    checkpoint["text_cache"], model.module.text_params
+                )
 
             if args.resume_optimizer:
                 optimizer.load_state_dict(checkpoint["optimizer"])
@@ -211,6 +298,12 @@ def main_worker(gpu, args):
 
         # shuffle loader
         train_sampler.set_epoch(epoch_log)
+        prefetch = args.get("prefetch", 0) and isinstance(train_data, RefDataset)
+        if prefetch:
+            order = list(train_sampler)
+            if args.get("aspect_buckets"):
+                order = [index for batch in order for index in batch]
+            train_data.set_prefetch_order(order, args.batch_size, args.workers)
 
         # train
         train_iou, train_loss = train(
@@ -223,6 +316,13 @@ def main_worker(gpu, args):
             args,
         )
 
+        if prefetch:
+            stats = train_data.prefetch_summary()
+            logger.info(
+                "Prefetch: {reads} records, hit rate {hit_rate:.2%}, "
+                "stall {stall_ms:.2f} ms/record".format(**stats)
+            )
+
         # evaluation
         iou, prec_dict = validate(
             val_loader, model, epoch_log, args, train_iou, train_loss
@@ -231,18 +331,22 @@ def main_worker(gpu, args):
         # save model
         if dist.get_rank() == 0:
             lastname = os.path.join(args.output_dir, "last_model.pth")
-            torch.save(
-                {
-                    "epoch": epoch_log,
-                    "cur_iou": iou,
-                    "best_iou": best_IoU,
-                    "prec": prec_dict,
-                    "state_dict": model.state_dict(),
-                    "optimizer": optimizer.state_dict(),
-                    "scheduler": scheduler.state_dict(),
-                },
-                lastname,
-            )
+            checkpoint = {
+                "epoch": epoch_log,
+                "cur_iou": iou,
+                "best_iou": best_IoU,
+                "prec": prec_dict,
+                "state_dict": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+            }
+            text_cache = model.module.text_cache
+            if text_cache is not None:
+                # text features of the prompts seen so far, for test / serving
+                checkpoint["text_cache"] = text_cache.state_dict(
+                    model.module.text_params
+                )
+            torch.save(checkpoint, lastname)
             if iou >= best_IoU:
                 best_IoU = iou
                 bestname = os.path.join(args.output_dir, "best_model.pth")
@@ -1,15 +1,20 @@
 import ast
+import hashlib
+import json
 import os
+import shutil
+from collections import OrderedDict
 from typing import List, Union
 
 import cv2
-import lmdb
 import numpy as np
-import pyarrow as pa
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 
+from .record import decode_mask
 from .simple_tokenizer import SimpleTokenizer as _Tokenizer
+from .storage import Prefetcher, ShardRecord, build_backend
 
 info = {
     "refcoco": {
@@ -55,6 +60,62 @@ info = {
 _tokenizer = _Tokenizer()
 
 
+# whole-prompt token rows, shared by all calls in this (worker) process
+_prompt_cache = OrderedDict()
+_prompt_cache_size = 4096
+
+
+def _encode_prompt(text):
+    tokens = _prompt_cache.get(text)
+    if tokens is None:
+        sot_token = _tokenizer.encoder["<|startoftext|>"]
+        eot_token = _tokenizer.encoder["<|endoftext|>"]
+        tokens = np.array(
+            [sot_token] + _tokenizer.encode(text) + [eot_token], dtype=np.int64
+        )
+        _prompt_cache[text] = tokens
+        if len(_prompt_cache) > _prompt_cache_size:
+            _prompt_cache.popitem(last=False)
+    else:
+        _prompt_cache.move_to_end(text)
+    return tokens
+
+
+def tokenize_batch(
+    texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False
+) -> np.ndarray:
+    """
+    Numpy version of `tokenize`. Identical prompts are encoded once, encoded
+    prompts are kept in a bounded LRU, and the padded [n, context_length]
+    int64 array is filled with a single masked assignment.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+
+    eot_token = _tokenizer.encoder["<|endoftext|>"]
+    rows = {}
+    for text in dict.fromkeys(texts):
+        tokens = _encode_prompt(text)
+        if len(tokens) > context_length:
+            if truncate:
+                tokens = tokens[:context_length].copy()
+                tokens[-1] = eot_token
+            else:
+                raise RuntimeError(
+                    f"Input {text} is too long for context length {context_length}"
+                )
+        rows[text] = tokens
+
+    all_tokens = [rows[text] for text in texts]
+    lengths = np.array([len(tokens) for tokens in all_tokens], dtype=np.int64)
+    result = np.zeros((len(all_tokens), context_length), dtype=np.int64)
+    if len(all_tokens) > 0:
+        result[np.arange(context_length) < lengths[:, None]] = np.concatenate(
+            all_tokens
+        )
+    return result
+
+
 def tokenize(
     texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False
 ) -> torch.LongTensor:
@@ -76,34 +137,318 @@ def tokenize(
     -------
     A two-dimensional tensor containing the resulting tokens, shape = [number of input strings, context_length]
     """
-    if isinstance(texts, str):
-        texts = [texts]
+    return torch.from_numpy(tokenize_batch(texts, context_length, truncate))
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
 
-    for i, tokens in enumerate(all_tokens):
-        if len(tokens) > context_length:
-            if truncate:
-                tokens = tokens[:context_length]
-                tokens[-1] = eot_token
-            else:
-                raise RuntimeError(
-                    f"Input {texts[i]} is too long for context length {context_length}"
-                )
-        result[i, : len(tokens)] = torch.tensor(tokens)
+def tokenize_prompts(prompts, word_len):
+    """
+    Tokenize every sentence of every prompt type of a sample.
+
+    Returns the token table meta ({"word_len", "rows": {type: [start, count]}})
+    and an int32 [num_sentences, word_len] array. Sentences are normalized the
+    same way as in `RefDataset.__getitem__` (a string becomes a single
+    sentence, an empty list becomes [""]), so row `start + idx` holds the
+    tokens of sentence `idx`.
+    """
+    sents, rows = [], {}
+    for prompt_type, prompt in prompts.items():
+        if type(prompt) != list:
+            prompt = [prompt]
+        elif len(prompt) == 0:
+            prompt = [""]
+        rows[prompt_type] = [len(sents), len(prompt)]
+        sents.extend(prompt)
+    tokens = tokenize_batch(sents, word_len, True).astype(np.int32)
+    return {"word_len": word_len, "rows": rows}, tokens
+
+
+pixel_mean = (0.48145466, 0.4578275, 0.40821073)
+pixel_std = (0.26862954, 0.26130258, 0.27577711)
+# per-device (scale, shift) so that normalized = uint8 * scale + shift
+_normalize_params = {}
+
+
+def normalize_image(img: torch.Tensor) -> torch.Tensor:
+    """
+    Normalize a uint8 [N, 3, H, W] (or [3, H, W]) batch as returned with
+    `device_normalize=True`, on whatever device it lives: a single
+    multiply-add of `(img / 255 - mean) / std` in float32.
+    """
+    params = _normalize_params.get(img.device)
+    if params is None:
+        mean = torch.tensor(pixel_mean, dtype=torch.float64).reshape(3, 1, 1)
+        std = torch.tensor(pixel_std, dtype=torch.float64).reshape(3, 1, 1)
+        params = (
+            (1.0 / (255.0 * std)).float().to(img.device),
+            (-mean / std).float().to(img.device),
+        )
+        _normalize_params[img.device] = params
+    scale, shift = params
+    return torch.addcmul(shift, img.float(), scale)
+
+
+reduced_flags = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def jpeg_size(buf):
+    """(height, width) from the SOF marker of a JPEG, None for other files."""
+    buf = bytes(buf[:65536]) if len(buf) > 65536 else bytes(buf)
+    if buf[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 9 < len(buf):
+        if buf[pos] != 0xFF:
+            return None
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = int.from_bytes(buf[pos + 2 : pos + 4], "big")
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h = int.from_bytes(buf[pos + 5 : pos + 7], "big")
+            w = int.from_bytes(buf[pos + 7 : pos + 9], "big")
+            return h, w
+        pos += 2 + length
+    return None
+
+
+def png_size(buf):
+    """(height, width) from the IHDR chunk of a PNG, None for other files."""
+    head = bytes(buf[:24])
+    if len(head) < 24 or head[:8] != b"\x89PNG\r\n\x1a\n" or head[12:16] != b"IHDR":
+        return None
+    return int.from_bytes(head[20:24], "big"), int.from_bytes(head[16:20], "big")
+
+
+def image_size(buf):
+    """(height, width) of an encoded image, from its header when possible."""
+    buf = np.frombuffer(buf, np.uint8)
+    size = jpeg_size(buf) or png_size(buf)
+    if size is None:
+        size = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE).shape[:2]
+    return size
 
-    return result
 
+# w / h of the default aspect-ratio buckets
+aspect_ratios = (1 / 2, 2 / 3, 3 / 4, 1, 4 / 3, 3 / 2, 2)
 
-def loads_pyarrow(buf):
+
+def bucket_shapes(input_size, ratios, multiple=32):
+    """(h, w) of one rectangular input per aspect ratio (w / h), with about
+    input_size ** 2 pixels and both sides multiples of `multiple`."""
+    shapes = []
+    for ratio in ratios:
+        h = round(input_size / ratio ** 0.5 / multiple) * multiple
+        w = round(input_size * ratio ** 0.5 / multiple) * multiple
+        shapes.append((max(h, multiple), max(w, multiple)))
+    return shapes
+
+
+class RefParams(object):
+    """
+    Compact val / test params (`RefDataset(compact_params=True)`).
+
+    `geom` is float32 [..., 8]: the flattened inverse letterbox matrix
+    followed by the original (h, w); `index` replaces the mask paths, which
+    are resolved (and, in test mode, the original image decoded) with
+    `RefDataset.mask_path` / `RefDataset.original_image` only when needed.
+    `sents` holds the test sentences, None in val mode.
+    """
+
+    __slots__ = ("geom", "index", "sents")
+
+    def __init__(self, geom, index, sents=None):
+        self.geom = geom
+        self.index = index
+        self.sents = sents
+
+    @property
+    def inverse(self):
+        return self.geom[..., :6].reshape(*self.geom.shape[:-1], 2, 3)
+
+    @property
+    def ori_size(self):
+        return self.geom[..., 6:].long()
+
+
+def collate_params(batch):
+    """
+    DataLoader collate for `compact_params=True`: tensors are stacked and
+    the `RefParams` of the batch merged into one, without the per-field
+    dispatch of the default collate.
+    """
+    fields = list(zip(*batch))
+    params = fields[-1]
+    merged = RefParams(
+        torch.stack([p.geom for p in params]),
+        torch.tensor([p.index for p in params], dtype=torch.int64),
+        None if params[0].sents is None else [p.sents for p in params],
+    )
+    return [torch.stack(field) for field in fields[:-1]] + [merged]
+
+
+class RawImage(object):
+    """
+    A decoded, not yet letterboxed train image (`device_letterbox=True`):
+    uint8 RGB [3, h, w] `img` (possibly a reduced decode), the `img_size`
+    its mask and affine maps are defined on, its `input_size` and the
+    dataset's letterbox `options` (see `letterbox_batch`).
+    """
+
+    __slots__ = ("img", "img_size", "input_size", "options")
+
+    def __init__(self, img, img_size, input_size, options):
+        self.img = img
+        self.img_size = img_size
+        self.input_size = input_size
+        self.options = options
+
+
+class RawBatch(object):
+    """
+    `RawImage`s of a batch as one uint8 [N, 3, H, W] tensor, padded with the
+    mean pixel up to the largest image, with their decoded `shapes` and
+    `sizes` ([N, 2] int64 (h, w) each). Moved to the device with `to` and
+    letterboxed there with `letterbox`.
+    """
+
+    __slots__ = ("images", "shapes", "sizes", "input_size", "options")
+
+    def __init__(self, images, shapes, sizes, input_size, options):
+        self.images = images
+        self.shapes = shapes
+        self.sizes = sizes
+        self.input_size = input_size
+        self.options = options
+
+    def pin_memory(self):
+        return RawBatch(
+            self.images.pin_memory(),
+            self.shapes,
+            self.sizes,
+            self.input_size,
+            self.options,
+        )
+
+    def to(self, device, non_blocking=False):
+        return RawBatch(
+            self.images.to(device, non_blocking=non_blocking),
+            self.shapes,
+            self.sizes,
+            self.input_size,
+            self.options,
+        )
+
+    def letterbox(self, masks):
+        return letterbox_batch(self, masks, **self.options)
+
+
+def collate_raw(batch):
+    """
+    DataLoader collate for `device_letterbox=True`: images and masks of any
+    size are padded into a `RawBatch` and one uint8 [N, H, W] mask tensor.
+    """
+    raws, words, masks = zip(*batch)
+    input_size = raws[0].input_size
+    assert all(raw.input_size == input_size for raw in raws), (
+        "one input size per batch, see utils.sampler.AspectRatioBatchSampler"
+    )
+    shapes = torch.tensor([raw.img.shape[1:] for raw in raws], dtype=torch.int64)
+    sizes = torch.tensor([raw.img_size for raw in raws], dtype=torch.int64)
+    h, w = shapes.max(0).values.tolist()
+    fill = torch.tensor([round(m * 255) for m in pixel_mean], dtype=torch.uint8)
+    images = fill.reshape(1, 3, 1, 1).repeat(len(raws), 1, h, w)
+    for image, raw in zip(images, raws):
+        image[:, : raw.img.shape[1], : raw.img.shape[2]] = raw.img
+    h, w = sizes.max(0).values.tolist()
+    padded = torch.zeros((len(masks), h, w), dtype=torch.uint8)
+    for out, mask in zip(padded, masks):
+        out[: mask.shape[0], : mask.shape[1]] = mask
+    raw = RawBatch(images, shapes, sizes, input_size, raws[0].options)
+    return raw, torch.stack(words), padded
+
+
+def _letterbox_axis(out_len, stride, inp_len, scale, bias, ratio, padded, gain):
     """
-    Args:
-        buf: the output of `dumps`.
+    Coefficients (a, b) of the affine_grid coordinate `a * x + b` sampling
+    output coordinate x along one axis: the output pixel at stride `stride`,
+    zoomed / flipped by `gain` around the input centre, mapped back through
+    the letterbox (`scale`, `bias`) to the source pixel (times `ratio`, less
+    the block-centre offset, for reduced decodes) and normalized to the padded
+    source length.
     """
-    return pa.deserialize(buf)
+    a = stride * out_len / 2.0
+    b = stride * (out_len - 1) / 2.0
+    centre = (inp_len - 1) / 2.0
+    a, b = gain * a, gain * (b - centre) + centre
+    a, b = a * ratio / scale, (b - bias) * ratio / scale - (1.0 - ratio) / 2.0
+    return 2.0 * a / padded, (2.0 * b + 1.0) / padded - 1.0
+
+
+def letterbox_batch(raw, masks=None, mask_stride=1, scale_range=None, flip=False):
+    """
+    Letterbox a `RawBatch` on its device, with the geometry of
+    `RefDataset.letterbox`: one affine_grid / grid_sample (bicubic) call for
+    the images and one (bilinear) for the masks, which are sampled at every
+    `mask_stride`-th output pixel.
+
+    With `scale_range` (lo, hi) each sample is zoomed by a factor drawn
+    uniformly from it around the input centre, with `flip` it is mirrored
+    horizontally with probability 0.5; both apply to image and mask alike.
+    Returns normalized float [N, 3, h, w] images and float [N, 1, h / s,
+    w / s] masks in [0, 1] (None without `masks`).
+    """
+    images = normalize_image(raw.images)
+    n, _, pad_h, pad_w = images.shape
+    device = images.device
+    inp_h, inp_w = raw.input_size
+    sizes = raw.sizes.to(device, torch.float32)
+    shapes = raw.shapes.to(device, torch.float32)
+    ori_h, ori_w = sizes[:, 0], sizes[:, 1]
+    scale = torch.minimum(inp_h / ori_h, inp_w / ori_w)
+    bias_x = (inp_w - ori_w * scale) / 2.0
+    bias_y = (inp_h - ori_h * scale) / 2.0
+    gain_x = torch.ones(n, device=device)
+    gain_y = torch.ones(n, device=device)
+    if scale_range is not None:
+        lo, hi = scale_range
+        zoom = torch.empty(n, device=device).uniform_(lo, hi)
+        gain_x, gain_y = gain_x / zoom, gain_y / zoom
+    if flip:
+        gain_x = torch.where(torch.rand(n, device=device) < 0.5, -gain_x, gain_x)
+
+    def warp(src, stride, ratio_y, ratio_x, mode):
+        out_h, out_w = inp_h // stride, inp_w // stride
+        ax, bx = _letterbox_axis(
+            out_w, stride, inp_w, scale, bias_x, ratio_x, src.shape[-1], gain_x
+        )
+        ay, by = _letterbox_axis(
+            out_h, stride, inp_h, scale, bias_y, ratio_y, src.shape[-2], gain_y
+        )
+        zero = torch.zeros_like(ax)
+        theta = torch.stack(
+            [torch.stack([ax, zero, bx], 1), torch.stack([zero, ay, by], 1)], 1
+        )
+        grid = F.affine_grid(theta, (n, 1, out_h, out_w), align_corners=False)
+        return F.grid_sample(
+            src, grid, mode=mode, padding_mode="zeros", align_corners=False
+        )
+
+    # normalized images are 0 outside the source, i.e. the mean pixel
+    images = warp(images, 1, shapes[:, 0] / ori_h, shapes[:, 1] / ori_w, "bicubic")
+    if masks is None:
+        return images, None
+    masks = masks.unsqueeze(1).float().div_(255.0)
+    one = torch.ones_like(ori_h)
+    masks = warp(masks, mask_stride, one, one, "bilinear").clamp_(0.0, 1.0)
+    return images, masks
 
 
 class RefDataset(Dataset):
@@ -118,6 +463,18 @@ class RefDataset(Dataset):
         word_length,
         prompt_type,
         resize,
+        cache_dir=None,
+        backend="lmdb",
+        in_memory=False,
+        reduced_decode=False,
+        device_normalize=False,
+        target_stride=1,
+        compact_params=False,
+        prefetch=0,
+        aspect_buckets=None,
+        device_letterbox=False,
+        scale_range=None,
+        flip=False,
     ):
         super(RefDataset, self).__init__()
         self.lmdb_dir = lmdb_dir
@@ -127,43 +484,95 @@ class RefDataset(Dataset):
         self.mode = mode
         self.input_size = (input_size, input_size)
         self.word_length = word_length
-        self.mean = torch.tensor([0.48145466, 0.4578275, 0.40821073]).reshape(3, 1, 1)
-        self.std = torch.tensor([0.26862954, 0.26130258, 0.27577711]).reshape(3, 1, 1)
-        self.length = info[dataset][split]
-        self.env = None
+        self.mean = torch.tensor(pixel_mean).reshape(3, 1, 1)
+        self.std = torch.tensor(pixel_std).reshape(3, 1, 1)
+        # return uint8 images (and train masks), see `normalize_image`
+        self.device_normalize = device_normalize
+        # train masks are emitted at the model's output stride (4 for the
+        # Projector), sampled like F.interpolate(mode="nearest")
+        assert input_size % target_stride == 0, (
+            f"input_size {input_size} is not a multiple of "
+            f"target_stride {target_stride}"
+        )
+        self.target_stride = target_stride
+        # val / test params as `RefParams`, batched with `collate_params`
+        self.compact_params = compact_params
+        self.mask_names = None
+        # records advised ahead of use per worker, see `set_prefetch_order`
+        self.prefetch = prefetch
+        self.prefetch_order = None
+        self.prefetcher = None
+        if split in info.get(dataset, {}):
+            self.length = info[dataset][split]
+        else:
+            self.length = None
+        self.backend = backend
+        self.db = build_backend(backend, lmdb_dir)
         self.prompt_type = prompt_type
         self.resize = resize
-
-    def _init_db(self):
-        self.env = lmdb.open(
-            self.lmdb_dir,
-            subdir=os.path.isdir(self.lmdb_dir),
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False,
+        # pre-letterboxed uint8 store built by tools/build_letterbox_cache.py
+        self.cache_dir = cache_dir
+        self.cache_images = None
+        self.cache_tokens = None
+        self.reduced_decode = reduced_decode
+        # decode the val split once into RAM, see `_preload`
+        self.in_memory = in_memory and mode == "val"
+        if self.in_memory:
+            self._preload()
+        # rectangular inputs per aspect-ratio bucket, batched by
+        # utils.sampler.AspectRatioBatchSampler
+        self.aspect_buckets = aspect_buckets
+        self.sample_buckets = None
+        if aspect_buckets:
+            assert cache_dir is None and not self.in_memory, (
+                "aspect_buckets needs the backend path, not a letterbox cache"
+            )
+            assert 32 % target_stride == 0, "bucket sides are multiples of 32"
+            ratios = aspect_ratios if aspect_buckets is True else aspect_buckets
+            self._init_buckets(ratios)
+        # train samples are decoded only and letterboxed (plus zoom / flip
+        # augmentation) per batch on the device, see `letterbox_batch`
+        self.device_letterbox = device_letterbox and mode == "train"
+        assert self.device_letterbox or (scale_range is None and not flip), (
+            "scale_range / flip are applied by the device letterbox"
         )
-        with self.env.begin(write=False) as txn:
-            dgth = loads_pyarrow(txn.get(b"__len__"))
-            self.keys = loads_pyarrow(txn.get(b"__keys__"))
+        if self.device_letterbox:
+            assert cache_dir is None, "device_letterbox needs the backend path"
+        self.letterbox_options = {
+            "mask_stride": target_stride,
+            "scale_range": tuple(scale_range) if scale_range else None,
+            "flip": flip,
+        }
 
     def __len__(self):
+        if self.length is None:
+            # not listed in `info`: count the records once, without keeping
+            # the handle for the workers
+            self.length = len(self.db)
+            self.db.close()
         return self.length
 
     def __getitem__(self, index):
-        # Delay loading LMDB data until after initialization: https://github.com/chainer/chainermn/issues/129
-        if self.env is None:
-            self._init_db()
-        env = self.env
-        with env.begin(write=False) as txn:
-            byteflow = txn.get(self.keys[index])
-        ref = loads_pyarrow(byteflow)
-        # img
-        ori_img = cv2.imdecode(np.frombuffer(ref["img"], np.uint8), cv2.IMREAD_COLOR)
-        img = cv2.cvtColor(ori_img, cv2.COLOR_BGR2RGB)
-        if self.resize:
-            img = cv2.resize(img, (224, 224))
-        img_size = img.shape[:2]
+        if self.in_memory:
+            ref = self.memory_refs[index]
+            img = self.memory_images[index]
+            mat_inv = self.memory_inverse[index]
+            img_size = tuple(self.memory_sizes[index])
+        elif self.cache_dir is not None and self.mode != "test":
+            img, mask, img_size, ref = self._load_cached(index)
+            mat_inv = self.getTransformMat(img_size, True)[1]
+        else:
+            ref = self.fetch(index)
+            if self.device_letterbox:
+                # warped with the rest of the batch, see `collate_raw`
+                img, mask = self.raw_sample(ref, index)
+            else:
+                ori_img, img, mask, img_size, mat_inv = self.letterbox(
+                    ref,
+                    with_mask=self.mode == "train",
+                    mask_stride=self.target_stride,
+                    input_size=self.sample_input_size(index),
+                )
         # mask
         mask_name = ref["mask_name"]
         mask_dir = os.path.join(self.mask_dir, mask_name)
@@ -206,47 +615,39 @@ class RefDataset(Dataset):
         # if type(sents) != "list"
         # print(sents, type(sents))
         idx = np.random.choice([i for i in range(len(sents))])
-        # transform
-        mat, mat_inv = self.getTransformMat(img_size, True)
-        img = cv2.warpAffine(
-            img,
-            mat,
-            self.input_size,
-            flags=cv2.INTER_CUBIC,
-            borderValue=[0.48145466 * 255, 0.4578275 * 255, 0.40821073 * 255],
-        )
 
         if self.mode == "train":
-            # mask transform
-            mask = cv2.imdecode(
-                np.frombuffer(ref["mask"], np.uint8), cv2.IMREAD_GRAYSCALE
-            )
-            if self.resize:
-                mask = cv2.resize(mask, (224, 224))
-            mask = cv2.warpAffine(
-                mask, mat, self.input_size, flags=cv2.INTER_LINEAR, borderValue=0.0
-            )
-            mask = mask / 255.0
             # sentence -> vector
             sent = sents[idx]
-
-            word_vec = tokenize(sent, self.word_length, True).squeeze(0)
+            word_vec = self.word_vec(ref, prompt_type, idx, sent)
+            if self.device_letterbox:
+                return img, word_vec, mask
+            # uint8 masks are scaled by the consumer, see engine.train
+            if not self.device_normalize and self.target_stride == 1:
+                mask = mask / 255.0
             img, mask = self.convert(img, mask)
             return img, word_vec, mask
         elif self.mode == "val":
             # sentence -> vector
             sent = sents[0]
-            word_vec = tokenize(sent, self.word_length, True).squeeze(0)
+            word_vec = self.word_vec(ref, prompt_type, 0, sent)
             img = self.convert(img)[0]
+            if self.compact_params:
+                return img, word_vec, self.params(index, mat_inv, img_size)
             params = {
                 "mask_dir": mask_dir,
                 "inverse": mat_inv,
                 "ori_size": np.array(img_size),
             }
+            if self.in_memory:
+                # GT is looked up with `gt_mask(index)` in the main process
+                params["index"] = index
             return img, word_vec, params
         else:
             # sentence -> vector
             img = self.convert(img)[0]
+            if self.compact_params:
+                return img, self.params(index, mat_inv, img_size, sents)
             params = {
                 "ori_img": ori_img,
                 "mask_name": mask_name,
@@ -257,9 +658,316 @@ class RefDataset(Dataset):
             }
             return img, params
 
-    def getTransformMat(self, img_size, inverse=False):
+    def _init_buckets(self, ratios):
+        """Assign every sample to the bucket closest in log aspect ratio."""
+        self.bucket_shapes = bucket_shapes(self.input_size[0], ratios)
+        bucket_ratios = np.log([w / h for h, w in self.bucket_shapes])
+        def read_sizes(db):
+            n = len(self) if self.length is not None else len(db)
+            sizes = np.empty((n, 2), dtype=np.int64)
+            for index in range(n):
+                if self.resize:
+                    sizes[index] = (224, 224)
+                else:
+                    sizes[index] = image_size(db.get(index)["img"])
+            return sizes
+
+        self.image_sizes = self.read_db(read_sizes)
+        ratios = np.log(self.image_sizes[:, 1] / self.image_sizes[:, 0])
+        self.sample_buckets = np.abs(ratios[:, None] - bucket_ratios).argmin(1)
+
+    def bucket_ids(self):
+        """Bucket of every sample (all 0 without `aspect_buckets`)."""
+        if self.sample_buckets is None:
+            return np.zeros(len(self), dtype=np.int64)
+        return self.sample_buckets
+
+    def sample_input_size(self, index):
+        """(h, w) letterbox size of a sample."""
+        if self.sample_buckets is None:
+            return self.input_size
+        return self.bucket_shapes[self.sample_buckets[index]]
+
+    def set_prefetch_order(self, order, batch_size, num_workers):
+        """
+        Hand the sampler order of the coming epoch to the workers (call in
+        the main process before iterating the DataLoader). Batches are
+        dispatched round-robin, so worker w reads batches w, w + n, ... and
+        prefetches only those records. Resets `prefetch_stats`.
+        """
+        if not self.prefetch:
+            return
+        if self.prefetcher is not None:
+            # it follows the previous order
+            self.prefetcher.stop()
+            self.prefetcher = None
+        self.prefetch_order = (list(order), batch_size, max(num_workers, 1))
+        self.prefetch_stats = torch.zeros(
+            max(num_workers, 1), 3, dtype=torch.float64
+        ).share_memory_()
+        self.prefetcher = None
+
+    def fetch(self, index):
+        if self.prefetch_order is None:
+            return self.db.get(index)
+        if self.prefetcher is None:
+            order, batch_size, num_workers = self.prefetch_order
+            worker = torch.utils.data.get_worker_info()
+            worker_id = worker.id if worker is not None else 0
+            batches = [
+                order[start : start + batch_size]
+                for start in range(0, len(order), batch_size)
+            ]
+            own = [i for batch in batches[worker_id::num_workers] for i in batch]
+            self.prefetcher = Prefetcher(
+                self.db, own, self.prefetch, self.prefetch_stats[worker_id]
+            )
+        return self.prefetcher.get(index)
+
+    def prefetch_summary(self):
+        """Records read, prefetch hit rate and mean stall (ms) per record
+        over all workers since the last `set_prefetch_order`."""
+        reads, hits, stall = self.prefetch_stats.sum(0).tolist()
+        return {
+            "reads": int(reads),
+            "hit_rate": hits / max(reads, 1),
+            "stall_ms": 1e3 * stall / max(reads, 1),
+        }
+
+    def params(self, index, mat_inv, img_size, sents=None):
+        geom = np.empty(8, dtype=np.float32)
+        geom[:6] = np.asarray(mat_inv).ravel()
+        geom[6:] = img_size
+        return RefParams(torch.from_numpy(geom), index, sents)
+
+    def read_db(self, read):
+        """
+        `read(db)` for the main process: on `self.db` when it is already open
+        here (`num_workers=0`, LMDB refuses a second environment on the same
+        path), otherwise on a short-lived backend so that no open handle is
+        inherited by the DataLoader workers forked for the next epoch.
+        """
+        if self.db.is_open:
+            return read(self.db)
+        db = build_backend(self.backend, self.lmdb_dir)
+        try:
+            return read(db)
+        finally:
+            db.close()
+
+    def mask_name(self, index):
+        """`mask_name` of a sample, for compact params in the main process."""
+        if self.in_memory:
+            return self.memory_refs[index]["mask_name"]
+        if self.mask_names is None:
+            self.mask_names = self.read_db(
+                lambda db: [db.get(i)["mask_name"] for i in range(len(db))]
+            )
+        return self.mask_names[index]
+
+    def mask_path(self, index):
+        return os.path.join(self.mask_dir, self.mask_name(index))
+
+    def original_image(self, index):
+        """Full-resolution BGR image of a sample (test visualization)."""
+        return self.read_db(
+            lambda db: cv2.imdecode(
+                np.frombuffer(db.get(index)["img"], np.uint8), cv2.IMREAD_COLOR
+            )
+        )
+
+    def word_vec(self, ref, prompt_type, idx, sent):
+        """Token ids of `sent`, taken from the record's pre-tokenized table
+        when it was built with the same `word_length`."""
+        table = ref["tokens"] if "tokens" in ref else None
+        if table is not None and table["word_len"] == self.word_length:
+            start, _ = table["rows"][f"{prompt_type}"]
+            return torch.from_numpy(ref.token_rows()[start + idx].astype(np.int64))
+        return tokenize(sent, self.word_length, True).squeeze(0)
+
+    def letterbox(self, ref, with_mask=True, mask_stride=1, input_size=None):
+        """Decode a record and warp image (and mask) into `input_size`
+        ((h, w), `self.input_size` by default).
+
+        Returns the original BGR image, the letterboxed RGB image, the
+        letterboxed uint8 mask (None if `with_mask` is False) at
+        `input_size // mask_stride`, the decoded image size and the inverse
+        affine matrix.
+        """
+        input_size = input_size or self.input_size
+        ori_img, img, img_size, factor = self.decode_image(ref, input_size)
+        # transform
+        mat, mat_inv = self.getTransformMat(img_size, True, input_size)
+        img_mat = mat
+        if factor > 1:
+            # reduced pixel (x, y) averages a block of original pixels, its
+            # centre is (x * sx + (sx - 1) / 2, y * sy + (sy - 1) / 2) with
+            # sx = w / rw, sy = h / rh
+            sx, sy = img_size[1] / img.shape[1], img_size[0] / img.shape[0]
+            img_mat = mat.copy()
+            img_mat[:, 2] += mat[:, 0] * (sx - 1) / 2 + mat[:, 1] * (sy - 1) / 2
+            img_mat[:, 0] *= sx
+            img_mat[:, 1] *= sy
+        img = cv2.warpAffine(
+            img,
+            img_mat,
+            input_size[::-1],
+            flags=cv2.INTER_CUBIC,
+            borderValue=[0.48145466 * 255, 0.4578275 * 255, 0.40821073 * 255],
+        )
+        mask = None
+        if with_mask:
+            # mask transform
+            mask = self.decode_mask(ref)
+            mask_mat, mask_size = mat, input_size[::-1]
+            if mask_stride > 1:
+                # only evaluate the full-size warp at every stride-th pixel,
+                # i.e. the samples nearest-neighbour downscaling would keep
+                mask_mat = mat / mask_stride
+                mask_size = tuple(size // mask_stride for size in input_size[::-1])
+            mask = cv2.warpAffine(
+                mask, mask_mat, mask_size, flags=cv2.INTER_LINEAR, borderValue=0.0
+            )
+        return ori_img, img, mask, img_size, mat_inv
+
+    def decode_image(self, ref, input_size):
+        """
+        Decode the image of a record: the original BGR image, the RGB image
+        to warp (resized, or a reduced decode at 1 / `factor` resolution),
+        and the size the affine maps are defined on.
+        """
+        buf = np.frombuffer(ref["img"], np.uint8)
+        factor, ori_img = 1, None
+        if self.reduced_decode and not self.resize and self.mode != "test":
+            # DCT-domain downscaled decode for sources much larger than
+            # input_size; the affine maps stay defined on the original size
+            img_size = jpeg_size(buf)
+            if img_size is not None:
+                factor = self.reduce_factor(img_size, input_size)
+            if factor > 1:
+                ori_img = cv2.imdecode(buf, reduced_flags[factor])
+                h, w = img_size
+                if ori_img is None or ori_img.shape[:2] != (
+                    -(-h // factor),
+                    -(-w // factor),
+                ):
+                    factor, ori_img = 1, None
+        if ori_img is None:
+            ori_img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        img = cv2.cvtColor(ori_img, cv2.COLOR_BGR2RGB)
+        if self.resize:
+            img = cv2.resize(img, (224, 224))
+        if factor == 1:
+            img_size = img.shape[:2]
+        return ori_img, img, img_size, factor
+
+    def raw_sample(self, ref, index):
+        """`RawImage` and full-size uint8 mask tensor of a train record."""
+        input_size = self.sample_input_size(index)
+        img, img_size = self.decode_image(ref, input_size)[1:3]
+        img = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1))))
+        raw = RawImage(img, tuple(img_size), input_size, self.letterbox_options)
+        return raw, torch.from_numpy(self.decode_mask(ref))
+
+    def reduce_factor(self, img_size, input_size=None):
+        """Largest JPEG reduction that keeps the image at least as large as
+        its letterboxed size."""
+        inp_h, inp_w = input_size or self.input_size
+        scale = min(inp_h / img_size[0], inp_w / img_size[1])
+        for factor in (8, 4, 2):
+            if factor * scale <= 1:
+                return factor
+        return 1
+
+    def decode_mask(self, ref):
+        """uint8 mask of a record at the (optionally resized) image size."""
+        mask = decode_mask(ref["mask"])
+        if self.resize:
+            mask = cv2.resize(mask, (224, 224))
+        return mask
+
+    def _preload(self):
+        """
+        Decode the whole split once: letterboxed uint8 inputs, inverse
+        matrices, and the GT masks (from the record, not `mask_root`) as
+        packed bits at original resolution.
+        """
+        n = len(self)
+        h, w = self.input_size
+        self.memory_images = np.empty((n, h, w, 3), dtype=np.uint8)
+        self.memory_inverse = np.empty((n, 2, 3), dtype=np.float64)
+        self.memory_sizes = np.empty((n, 2), dtype=np.int64)
+        self.memory_masks = []
+        self.memory_refs = []
+        for index in range(n):
+            ref = self.db.get(index)
+            _, img, _, img_size, mat_inv = self.letterbox(ref, with_mask=False)
+            self.memory_images[index] = img
+            self.memory_inverse[index] = mat_inv
+            self.memory_sizes[index] = img_size
+            self.memory_masks.append(np.packbits(self.decode_mask(ref) != 0))
+            meta = {"mask_name": ref["mask_name"], "prompts": ref["prompts"]}
+            tokens = None
+            if "tokens" in ref:
+                meta["tokens"] = ref["tokens"]
+                tokens = np.array(ref.token_rows()).ravel()
+            self.memory_refs.append(ShardRecord(None, None, meta, tokens))
+        # drop the handles opened here instead of sharing them with workers
+        self.db.close()
+
+    def gt_mask(self, index):
+        """Boolean GT mask of a preloaded sample at original resolution."""
+        h, w = self.memory_sizes[index]
+        mask = np.unpackbits(self.memory_masks[index], count=h * w)
+        return mask.reshape(h, w).astype(bool)
+
+    def _init_cache(self):
+        with open(os.path.join(self.cache_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        assert tuple(meta["input_size"]) == self.input_size, (
+            f"cache at {self.cache_dir} was built for input_size "
+            f"{meta['input_size']}, expected {self.input_size}"
+        )
+        assert meta["resize"] == self.resize, "cache was built with resize={}".format(
+            meta["resize"]
+        )
+        # caches written before the flag was recorded used the full decode
+        reduced_decode = meta.get("reduced_decode", False)
+        assert reduced_decode == bool(
+            self.reduced_decode
+        ), "cache was built with reduced_decode={}".format(reduced_decode)
+        self.cache_refs = meta["records"]
+        self.cache_images = np.load(
+            os.path.join(self.cache_dir, "images.npy"), mmap_mode="r"
+        )
+        self.cache_masks = np.load(
+            os.path.join(self.cache_dir, "masks.npy"), mmap_mode="r"
+        )
+        # pre-tokenized prompts, caches built before they were kept have no
+        # token tables in their records and tokenize instead
+        tokens = os.path.join(self.cache_dir, "tokens.npy")
+        if os.path.isfile(tokens):
+            self.cache_tokens = np.load(tokens, mmap_mode="r")
+
+    def _load_cached(self, index):
+        if self.cache_images is None:
+            self._init_cache()
+        meta = self.cache_refs[index]
+        tokens = None
+        if "tokens" in meta:
+            start, count = meta["token_span"]
+            tokens = self.cache_tokens[start : start + count]
+        ref = ShardRecord(None, None, meta, tokens)
+        img = np.array(self.cache_images[index])
+        mask = None
+        if self.mode == "train":
+            stride = self.target_stride
+            mask = np.array(self.cache_masks[index, ::stride, ::stride])
+        return img, mask, tuple(ref["ori_size"]), ref
+
+    def getTransformMat(self, img_size, inverse=False, input_size=None):
         ori_h, ori_w = img_size
-        inp_h, inp_w = self.input_size
+        inp_h, inp_w = input_size or self.input_size
         scale = min(inp_h / ori_h, inp_w / ori_w)
         new_h, new_w = ori_h * scale, ori_w * scale
         bias_x, bias_y = (inp_w - new_w) / 2.0, (inp_h - new_h) / 2.0
@@ -277,15 +985,19 @@ class RefDataset(Dataset):
         return mat, None
 
     def convert(self, img, mask=None):
-        # Image ToTensor & Normalize
-        img = torch.from_numpy(img.transpose((2, 0, 1)))
-        if not isinstance(img, torch.FloatTensor):
-            img = img.float()
-        img.div_(255.0).sub_(self.mean).div_(self.std)
-        # Mask ToTensor
+        if self.device_normalize:
+            # uint8 CHW image, normalized by the consumer
+            img = torch.from_numpy(np.ascontiguousarray(img.transpose((2, 0, 1))))
+        else:
+            # Image ToTensor & Normalize
+            img = torch.from_numpy(img.transpose((2, 0, 1)))
+            if not isinstance(img, torch.FloatTensor):
+                img = img.float()
+            img.div_(255.0).sub_(self.mean).div_(self.std)
+        # Mask ToTensor, uint8 masks are kept as is
         if mask is not None:
-            mask = torch.from_numpy(mask)
-            if not isinstance(mask, torch.FloatTensor):
+            mask = torch.from_numpy(np.ascontiguousarray(mask))
+            if mask.dtype != torch.uint8 and not isinstance(mask, torch.FloatTensor):
                 mask = mask.float()
         return img, mask
 
@@ -294,11 +1006,19 @@ class RefDataset(Dataset):
             self.__class__.__name__
             + "("
             + f"db_path={self.lmdb_dir}, "
+            + f"backend={self.backend}, "
             + f"dataset={self.dataset}, "
             + f"split={self.split}, "
             + f"mode={self.mode}, "
             + f"input_size={self.input_size}, "
-            + f"word_length={self.word_length}"
+            + f"word_length={self.word_length}, "
+            + f"cache_dir={self.cache_dir}, "
+            + f"device_normalize={self.device_normalize}, "
+            + f"target_stride={self.target_stride}, "
+            + f"compact_params={self.compact_params}, "
+            + f"prefetch={self.prefetch}, "
+            + f"aspect_buckets={self.aspect_buckets}, "
+            + f"device_letterbox={self.device_letterbox}"
         )
 
     # def get_length(self):
@@ -306,3 +1026,202 @@ class RefDataset(Dataset):
 
     # def get_sample(self, idx):
     #     return self.__getitem__(idx)
+
+
+def build_letterbox_cache(dataset, cache_dir):
+    """
+    Run the deterministic decode / letterbox steps of `dataset` once and store
+    the uint8 images and masks as `.npy` arrays that `RefDataset(cache_dir=...)`
+    memory-maps instead of decoding every epoch. Pre-tokenized prompts of the
+    records are kept in `tokens.npy`, so training from the cache does not
+    tokenize either.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    n = len(dataset)
+    h, w = dataset.input_size
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_dir, "images.npy"), mode="w+", dtype=np.uint8,
+        shape=(n, h, w, 3),
+    )
+    masks = np.lib.format.open_memmap(
+        os.path.join(cache_dir, "masks.npy"), mode="w+", dtype=np.uint8,
+        shape=(n, h, w),
+    )
+    records = []
+    tokens, token_pos = [], 0
+    for index in range(n):
+        ref = dataset.db.get(index)
+        _, img, mask, img_size, _ = dataset.letterbox(ref)
+        images[index] = img
+        masks[index] = mask
+        record = {
+            "mask_name": ref["mask_name"],
+            "img_name": ref["img_name"],
+            "prompts": ref["prompts"],
+            "ori_size": [int(img_size[0]), int(img_size[1])],
+        }
+        if "tokens" in ref:
+            # the record's token table, rows at token_span of tokens.npy
+            rows = np.array(ref.token_rows(), dtype=np.int32).ravel()
+            record["tokens"] = ref["tokens"]
+            record["token_span"] = [token_pos, len(rows)]
+            tokens.append(rows)
+            token_pos += len(rows)
+        records.append(record)
+    images.flush()
+    masks.flush()
+    np.save(
+        os.path.join(cache_dir, "tokens.npy"),
+        np.concatenate(tokens) if tokens else np.empty(0, dtype=np.int32),
+    )
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "input_size": [h, w],
+                "resize": bool(dataset.resize),
+                "reduced_decode": bool(dataset.reduced_decode),
+                "records": records,
+            },
+            f,
+        )
+    return n
+
+
+class ConcatRefDataset(Dataset):
+    """
+    Several `RefDataset`s, each with its own lmdb and `mask_root`, seen as one
+    split without building a combined LMDB. The global index is a
+    precomputed (source, local index) table. `weights` are per-source epoch
+    multipliers: source k contributes round(weights[k] * len(source k))
+    entries, whole repetitions first and then a fixed random subset.
+    """
+
+    def __init__(self, sources, weights=None, seed=0):
+        super(ConcatRefDataset, self).__init__()
+        self.sources = list(sources)
+        if weights is None:
+            weights = [1.0] * len(self.sources)
+        assert len(weights) == len(self.sources), "one weight per source"
+        rng = np.random.RandomState(seed)
+        source_index, local_index = [], []
+        for k, (source, weight) in enumerate(zip(self.sources, weights)):
+            n = len(source)
+            reps, rest = divmod(int(round(weight * n)), n) if n else (0, 0)
+            local = np.concatenate(
+                [np.tile(np.arange(n), reps), rng.permutation(n)[:rest]]
+            )
+            source_index.append(np.full(len(local), k, dtype=np.int64))
+            local_index.append(local.astype(np.int64))
+        self.source_index = np.concatenate(source_index)
+        self.local_index = np.concatenate(local_index)
+        self.weights = list(weights)
+        self.mode = self.sources[0].mode
+        self.in_memory = self.sources[0].in_memory
+        self.compact_params = self.sources[0].compact_params
+        self.device_letterbox = self.sources[0].device_letterbox
+
+    def __len__(self):
+        return len(self.source_index)
+
+    def locate(self, index):
+        return self.sources[self.source_index[index]], int(self.local_index[index])
+
+    def __getitem__(self, index):
+        source, local = self.locate(index)
+        item = source[local]
+        # val / test params refer to samples by index, make it global
+        params = item[-1]
+        if isinstance(params, RefParams):
+            params.index = index
+        elif isinstance(params, dict) and "index" in params:
+            params["index"] = index
+        return item
+
+    def bucket_ids(self):
+        # sources share input_size and ratios, so their bucket ids agree
+        ids = [source.bucket_ids() for source in self.sources]
+        return np.array(
+            [ids[k][i] for k, i in zip(self.source_index, self.local_index)],
+            dtype=np.int64,
+        )
+
+    def gt_mask(self, index):
+        source, local = self.locate(index)
+        return source.gt_mask(local)
+
+    def mask_name(self, index):
+        source, local = self.locate(index)
+        return source.mask_name(local)
+
+    def mask_path(self, index):
+        source, local = self.locate(index)
+        return source.mask_path(local)
+
+    def original_image(self, index):
+        source, local = self.locate(index)
+        return source.original_image(local)
+
+    def __repr__(self):
+        return (
+            self.__class__.__name__
+            + "("
+            + ", ".join(
+                "{} x{}".format(source, weight)
+                for source, weight in zip(self.sources, self.weights)
+            )
+            + ")"
+        )
+
+
+def storage_stamp(path):
+    """(name, size, mtime) of a storage file, or of every file of a storage
+    folder (LMDB subdir, shards): changes whenever it is rebuilt."""
+    path = os.path.realpath(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path))
+    else:
+        files = [path]
+    stamp = []
+    for f in files:
+        st = os.stat(f)
+        stamp.append([os.path.basename(f), st.st_size, st.st_mtime_ns])
+    return stamp
+
+
+def shared_cache_dir(dataset, root="/dev/shm"):
+    """Node-local letterbox cache folder of `dataset`, keyed by the settings
+    that change its content and by the size / mtime of its storage, so that
+    a rebuilt LMDB is cached again."""
+    key = json.dumps(
+        [
+            os.path.realpath(dataset.lmdb_dir),
+            storage_stamp(dataset.lmdb_dir),
+            list(dataset.input_size),
+            bool(dataset.resize),
+            bool(dataset.reduced_decode),
+        ]
+    )
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(
+        root, "cris_{}_{}_{}".format(dataset.dataset, dataset.split, digest)
+    )
+
+
+def build_shared_cache(dataset, root="/dev/shm"):
+    """
+    Letterbox `dataset` once into a tmpfs folder unless a complete cache is
+    already there, and return its path. Meant to run in one process per node
+    while the others wait on a barrier; every DataLoader worker of every
+    rank then memory-maps the same pages read-only via `cache_dir`. The
+    folder is kept for later runs (remove `/dev/shm/cris_*` to free it).
+    """
+    path = shared_cache_dir(dataset, root)
+    if os.path.isfile(os.path.join(path, "meta.json")):
+        return path
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    build_letterbox_cache(dataset, tmp)
+    # the records were read in this process, don't hand the handles to workers
+    dataset.db.close()
+    os.rename(tmp, path)
+    return path
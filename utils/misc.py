@@ -66,6 +66,21 @@ def worker_init_fn(worker_id, num_workers, rank, seed):
     random.seed(worker_seed)
 
 
+def multi_scale_size(sizes, epoch, step=0, seed=0):
+    """
+    Input size of a multi-scale training step, drawn from `sizes` by a
+    generator seeded with (seed, epoch, step): every rank picks the same
+    size without communicating. step=0 gives one size per epoch.
+    """
+    rng = np.random.RandomState([seed, epoch, step])
+    return int(sizes[rng.randint(len(sizes))])
+
+
+def scaled_input_size(shape, size, base):
+    """(h, w) `shape` rescaled by size / base, sides rounded to multiples of 32."""
+    return tuple(max(32, int(round(side * size / base / 32)) * 32) for side in shape)
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -0,0 +1,223 @@
+"""
+Versioned binary record layout for the LMDB datasets.
+
+A record is a fixed header followed by a section table and the raw section
+blobs::
+
+    magic "CRIS" | version (u16) | number of sections (u16)
+    n x [tag (4 bytes) | offset (u32) | length (u32)]
+    blob 0 | blob 1 | ...
+
+The encoded image is stored as it was read from disk (or, in LMDBs built
+with a blob store, referenced by its content hash, see `IREF`), the mask
+either as
+the encoded file or, for binary masks, as run lengths / packed bits, the
+remaining fields (names, prompts) as a small JSON blob and, optionally, the
+pre-tokenized prompts as an int32 array. A reader only slices `memoryview`s
+out of the LMDB buffer instead of deserializing and copying the image bytes
+into Python objects.
+"""
+import hashlib
+import json
+import struct
+
+import cv2
+import numpy as np
+
+MAGIC = b"CRIS"
+# version 2 records reference their image in a blob store instead of
+# embedding it; records without a reference are still written as version 1
+VERSION = 2
+FORMAT_KEY = b"__format__"
+FORMAT = MAGIC + b"/%d" % VERSION
+# path of the content-addressed image store, relative to the LMDB's folder
+BLOBS_KEY = b"__blobs__"
+
+IMG = b"IMG_"
+MASK = b"MASK"
+META = b"META"
+TOKS = b"TOKS"
+IREF = b"IREF"
+
+_HEADER = struct.Struct("<4sHH")
+_SECTION = struct.Struct("<4sII")
+
+# binary masks: magic | encoding | foreground value | height | width | payload
+MASK_MAGIC = b"MBIN"
+MASK_BITS = 1
+MASK_RLE = 2
+_MASK_HEADER = struct.Struct("<4sBBII")
+
+
+def record_key(index):
+    return "{}".format(index).encode("ascii")
+
+
+def blob_key(img):
+    """Content address of an encoded image in a blob store."""
+    return hashlib.blake2b(bytes(img), digest_size=16).digest()
+
+
+def dumps_record(img, mask, meta, extra=None, img_ref=None):
+    """
+    Args:
+        img: encoded image bytes, ignored if `img_ref` is given.
+        mask: encoded mask bytes.
+        meta: json-serializable dict (names, prompts).
+        extra: optional dict of additional {tag: bytes} sections.
+        img_ref: optional `blob_key` of the image in the LMDB's blob store.
+    Returns:
+        bytes of the encoded record.
+    """
+    img_section = (IMG, img) if img_ref is None else (IREF, img_ref)
+    sections = [img_section, (MASK, mask), (META, json.dumps(meta).encode("utf-8"))]
+    if extra:
+        sections.extend(extra.items())
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    table = []
+    for tag, blob in sections:
+        assert len(tag) == 4, "section tags are 4 bytes"
+        table.append(_SECTION.pack(tag, offset, len(blob)))
+        offset += len(blob)
+    header = _HEADER.pack(MAGIC, 1 if img_ref is None else 2, len(sections))
+    return b"".join([header] + table + [bytes(blob) for _, blob in sections])
+
+
+class Record(object):
+    """
+    Zero-copy view over an encoded record. `record["img"]` and
+    `record["mask"]` are `memoryview` slices of the underlying buffer, any
+    other key is looked up in the JSON meta section. The views are only valid
+    while the buffer (e.g. the LMDB read transaction) is alive. Images stored
+    by reference are looked up in `blobs` (anything with `get(key)`).
+    """
+
+    def __init__(self, buf, blobs=None):
+        self.buf = memoryview(buf)
+        self.blobs = blobs
+        magic, version, num = _HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("not a CRIS record")
+        if version > VERSION:
+            raise ValueError(
+                "record version {} is newer than supported {}".format(
+                    version, VERSION
+                )
+            )
+        self.version = version
+        self.sections = {}
+        for i in range(num):
+            tag, off, length = _SECTION.unpack_from(
+                self.buf, _HEADER.size + i * _SECTION.size
+            )
+            self.sections[tag] = (off, length)
+        self._meta = None
+
+    def section(self, tag):
+        off, length = self.sections[tag]
+        return self.buf[off : off + length]
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._meta = json.loads(bytes(self.section(META)))
+        return self._meta
+
+    def token_rows(self):
+        """int32 [num_sentences, word_len] view of the pre-tokenized prompts."""
+        word_len = self.meta["tokens"]["word_len"]
+        return np.frombuffer(self.section(TOKS), np.int32).reshape(-1, word_len)
+
+    def __getitem__(self, key):
+        if key == "img":
+            if IREF in self.sections:
+                if self.blobs is None:
+                    raise ValueError("record references a blob store that is not open")
+                return self.blobs.get(bytes(self.section(IREF)))
+            return self.section(IMG)
+        if key == "mask":
+            return self.section(MASK)
+        return self.meta[key]
+
+    def __contains__(self, key):
+        return key in ("img", "mask") or key in self.meta
+
+
+def encode_mask(mask):
+    """
+    Compact encoding of a binary uint8 mask (values 0 and a single foreground
+    value): row-major run lengths or packed bits, whichever is smaller.
+    Returns None if the mask is not binary.
+    """
+    values = np.unique(mask)
+    if len(values) > 2 or (len(values) == 2 and values[0] != 0):
+        return None
+    value = int(values[-1])
+    h, w = mask.shape
+    flat = mask.ravel() != 0
+    # runs alternate background / foreground, starting with background
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], change, [flat.size]])
+    runs = np.diff(bounds).astype(np.uint32)
+    if flat.size and flat[0]:
+        runs = np.concatenate([np.zeros(1, np.uint32), runs])
+    bits = np.packbits(flat)
+    if runs.nbytes < bits.nbytes:
+        kind, payload = MASK_RLE, runs.tobytes()
+    else:
+        kind, payload = MASK_BITS, bits.tobytes()
+    return _MASK_HEADER.pack(MASK_MAGIC, kind, value, h, w) + payload
+
+
+def decode_mask(buf):
+    """uint8 mask from a compact binary mask or an encoded image file."""
+    buf = memoryview(buf)
+    if bytes(buf[: len(MASK_MAGIC)]) != MASK_MAGIC:
+        return cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_GRAYSCALE)
+    _, kind, value, h, w = _MASK_HEADER.unpack_from(buf, 0)
+    payload = buf[_MASK_HEADER.size :]
+    if kind == MASK_RLE:
+        runs = np.frombuffer(payload, np.uint32)
+        values = np.zeros(len(runs), np.uint8)
+        values[1::2] = value
+        mask = np.repeat(values, runs)
+    else:
+        mask = np.unpackbits(np.frombuffer(payload, np.uint8), count=h * w)
+        mask *= value
+    return mask.reshape(h, w)
+
+
+def is_record(buf):
+    return bytes(buf[: len(MAGIC)]) == MAGIC
+
+
+def loads_pyarrow(buf):
+    """
+    Args:
+        buf: the output of the legacy `pa.serialize(obj).to_buffer()`.
+    """
+    # only needed for LMDBs built before the record format, and removed from
+    # recent pyarrow releases
+    import pyarrow as pa
+
+    return pa.deserialize(buf)
+
+
+def loads_record(buf, blobs=None):
+    """Decode a record, falling back to the legacy pyarrow dict."""
+    if is_record(buf):
+        return Record(buf, blobs)
+    return loads_pyarrow(buf)
+
+
+def read_keys(txn):
+    """Return the record keys of an LMDB written in either format."""
+    if txn.get(FORMAT_KEY) is not None:
+        length = int(bytes(txn.get(b"__len__")))
+        return [record_key(i) for i in range(length)]
+    return loads_pyarrow(txn.get(b"__keys__"))
+
+
+def write_index(txn, length):
+    txn.put(FORMAT_KEY, FORMAT)
+    txn.put(b"__len__", "{}".format(length).encode("ascii"))
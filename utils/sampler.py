@@ -0,0 +1,92 @@
+import math
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batches of samples from one aspect-ratio bucket (`dataset.bucket_ids()`),
+    so every batch shares the rectangular input size of its bucket.
+
+    With `drop_last` (training) samples are shuffled within their bucket,
+    cut into full batches and the batches shuffled with the epoch seed, then
+    dealt round-robin to the ranks: every rank runs the same number of
+    batches of `batch_size`. Without it (validation) the samples are split
+    among the ranks first, padded by repeating samples as DistributedSampler
+    does, and every rank batches its share by bucket: every rank sees the
+    same number of samples, so per-sample results can be all_gathered, in a
+    number of batches that may differ between ranks.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        shuffle=True,
+        drop_last=True,
+        seed=0,
+        num_replicas=None,
+        rank=None,
+    ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+        self.buckets = np.asarray(dataset.bucket_ids())
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, indices=None):
+        """Bucket batches of `indices` (default: all samples) for the epoch;
+        with `drop_last`, all batches before they are split among the
+        ranks."""
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if indices is None:
+            indices = np.arange(len(self.buckets))
+        buckets = self.buckets[indices]
+        batches = []
+        for bucket in np.unique(buckets):
+            members = indices[buckets == bucket]
+            if self.shuffle:
+                members = rng.permutation(members)
+            for start in range(0, len(members), self.batch_size):
+                batch = members[start : start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def rank_indices(self):
+        """Samples of this rank without `drop_last`: the dataset padded to a
+        multiple of the ranks by repeating samples, then strided."""
+        indices = np.arange(len(self.buckets))
+        if self.shuffle:
+            indices = np.random.RandomState(self.seed + self.epoch).permutation(indices)
+        total = math.ceil(len(indices) / self.num_replicas) * self.num_replicas
+        if len(indices) > 0:
+            indices = np.resize(indices, total)
+        return indices[self.rank :: self.num_replicas]
+
+    def __iter__(self):
+        if not self.drop_last:
+            return iter(self.batches(self.rank_indices()))
+        batches = self.batches()
+        batches = batches[: len(batches) - len(batches) % self.num_replicas]
+        return iter(batches[self.rank :: self.num_replicas])
+
+    def __len__(self):
+        if not self.drop_last:
+            return len(self.batches(self.rank_indices()))
+        return len(self.batches()) // self.num_replicas
@@ -1,9 +1,12 @@
 import gzip
+import heapq
 import html
 import os
+from collections import OrderedDict
 from functools import lru_cache
 
 import ftfy
+import numpy as np
 import regex as re
 
 
@@ -59,71 +62,156 @@ def whitespace_clean(text):
     return text
 
 
+def default_merges_cache():
+    return os.path.join(os.path.expanduser("~"), ".cache", "cris", "bpe_merges.npz")
+
+
+def load_merges(bpe_path):
+    """
+    Integer merge table: (left id, right id, merged id) per merge rank, plus
+    the vocab. Parsed from the gzip file; `SimpleTokenizer` caches the int
+    arrays so later startups skip the text parsing.
+    """
+    merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+    merges = merges[1:49152-256-2+1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v+'</w>' for v in vocab]
+    for merge in merges:
+        vocab.append(''.join(merge))
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    encoder = dict(zip(vocab, range(len(vocab))))
+    table = np.array([[encoder[a], encoder[b], encoder[a + b]] for a, b in merges],
+                     dtype=np.int32).reshape(-1, 3)
+    return table, vocab
+
+
+def vocab_from_merges(table):
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v+'</w>' for v in vocab]
+    for left, right, _ in table.tolist():
+        vocab.append(vocab[left] + vocab[right])
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    return vocab
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 10000,
+                 merges_cache: str = default_merges_cache()):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152-256-2+1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v+'</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+        table = None
+        stat = os.stat(bpe_path)
+        if merges_cache and os.path.isfile(merges_cache):
+            try:
+                with np.load(merges_cache) as cached:
+                    if cached["source"].tolist() == [stat.st_size, int(stat.st_mtime)]:
+                        table = cached["table"]
+            except Exception:
+                # unreadable cache, rebuilt from the gzip below
+                table = None
+        if table is None:
+            table, vocab = load_merges(bpe_path)
+            if merges_cache:
+                # other processes may be loading it: write aside, then
+                # atomically replace
+                tmp = "{}.{}.tmp".format(merges_cache, os.getpid())
+                try:
+                    os.makedirs(os.path.dirname(merges_cache), exist_ok=True)
+                    with open(tmp, "wb") as f:
+                        np.savez(f, table=table,
+                                 source=np.array([stat.st_size, int(stat.st_mtime)]))
+                    os.replace(tmp, merges_cache)
+                except OSError:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+        else:
+            vocab = vocab_from_merges(table)
         self.encoder = dict(zip(vocab, range(len(vocab))))
         self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        # (left id << 16 | right id) -> rank, merged ids indexed by rank
+        self.merge_ranks = dict(zip((table[:, 0].astype(np.int64) << 16 | table[:, 1]).tolist(),
+                                    range(len(table))))
+        self.merge_left = table[:, 0].tolist()
+        self.merge_right = table[:, 1].tolist()
+        self.merge_ids = table[:, 2].tolist()
+        self.special = {'<|startoftext|>': [self.encoder['<|startoftext|>']],
+                        '<|endoftext|>': [self.encoder['<|endoftext|>']]}
+        # bounded LRU of bpe results, one per DataLoader worker
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
 
-    def bpe(self, token):
+    def bpe_ids(self, token):
+        """
+        Token ids of one pre-token. Symbols are kept as a linked list of vocab
+        ids and candidate merges in a heap keyed by (rank, position); all
+        occurrences of the lowest rank are merged left to right before newly
+        formed pairs are considered, which reproduces the reference loop.
+        """
+        if token in self.special:
+            return self.special[token]
         if token in self.cache:
+            self.cache.move_to_end(token)
             return self.cache[token]
-        word = tuple(token[:-1]) + ( token[-1] + '</w>',)
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token+'</w>'
-
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
-        return word
+        encoder = self.encoder
+        ids = [encoder[c] for c in token[:-1]] + [encoder[token[-1] + '</w>']]
+        n = len(ids)
+        if n > 1:
+            ranks = self.merge_ranks
+            nxt = list(range(1, n + 1))
+            nxt[-1] = -1
+            prev = list(range(-1, n - 1))
+            heap = []
+            for i in range(n - 1):
+                rank = ranks.get(ids[i] << 16 | ids[i + 1])
+                if rank is not None:
+                    heap.append((rank, i))
+            heapq.heapify(heap)
+            while heap:
+                rank = heap[0][0]
+                left, right = self.merge_left[rank], self.merge_right[rank]
+                merged = self.merge_ids[rank]
+                done = []
+                while heap and heap[0][0] == rank:
+                    i = heapq.heappop(heap)[1]
+                    j = nxt[i]
+                    # stale entry: i was merged away or its pair changed
+                    if ids[i] != left or j == -1 or ids[j] != right:
+                        continue
+                    ids[i] = merged
+                    ids[j] = -1
+                    nxt[i] = nxt[j]
+                    if nxt[j] != -1:
+                        prev[nxt[j]] = i
+                    done.append(i)
+                for i in done:
+                    if ids[i] != merged:
+                        continue
+                    p, q = prev[i], nxt[i]
+                    if p != -1:
+                        r = ranks.get(ids[p] << 16 | ids[i])
+                        if r is not None:
+                            heapq.heappush(heap, (r, p))
+                    if q != -1:
+                        r = ranks.get(ids[i] << 16 | ids[q])
+                        if r is not None:
+                            heapq.heappush(heap, (r, i))
+            ids = [i for i in ids if i != -1]
+        self.cache[token] = ids
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return ids
+
+    def bpe(self, token):
+        return ' '.join(self.decoder[i] for i in self.bpe_ids(token))
 
     def encode(self, text):
         bpe_tokens = []
         text = whitespace_clean(basic_clean(text)).lower()
         for token in re.findall(self.pat, text):
             token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
+            bpe_tokens.extend(self.bpe_ids(token))
         return bpe_tokens
 
     def decode(self, tokens):
@@ -0,0 +1,392 @@
+"""
+Storage backends for `RefDataset`.
+
+Every backend maps a sample index to a record supporting `record["img"]`,
+`record["mask"]` (encoded bytes as buffers) and the meta keys
+(`mask_name`, `img_name`, `prompts`). Backends open their files lazily so
+that each DataLoader worker gets its own handles after fork.
+"""
+import copy
+import ctypes
+import json
+import mmap
+import os
+import threading
+import time
+
+import lmdb
+import numpy as np
+
+from .record import BLOBS_KEY, blob_key, loads_record, read_keys
+
+SHARD_IMAGES = "images.bin"
+SHARD_MASKS = "masks.bin"
+SHARD_TOKENS = "tokens.bin"
+SHARD_OFFSETS = "offsets.npy"
+SHARD_PROMPTS = "prompts.json"
+
+
+# blob stores opened by this process, shared by all LMDBs referencing them
+# (one environment per path and process is all lmdb allows)
+_blob_stores = {}
+
+
+class BlobStore(object):
+    """
+    Read-only content-addressed image store written by
+    `folder2lmdb.py --blob-store`: `blob_key(img)` -> encoded image. Each
+    image is stored, and page-cached, once for all splits and datasets that
+    reference it. Use `open_blob_store` / `close_blob_store`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.env = lmdb.open(
+            path,
+            subdir=os.path.isdir(path),
+            readonly=True,
+            lock=False,
+            readahead=False,
+            meminit=False,
+        )
+        self.txn = self.env.begin(write=False, buffers=True)
+        self.users = 0
+
+    def get(self, key):
+        blob = self.txn.get(key)
+        if blob is None:
+            raise KeyError(
+                "image {} is missing from blob store {}".format(key.hex(), self.path)
+            )
+        return blob
+
+
+def open_blob_store(path):
+    path = os.path.realpath(path)
+    store = _blob_stores.get(path)
+    if store is None:
+        store = _blob_stores[path] = BlobStore(path)
+    store.users += 1
+    return store
+
+
+def close_blob_store(store):
+    store.users -= 1
+    if store.users == 0:
+        store.txn.abort()
+        store.env.close()
+        del _blob_stores[store.path]
+
+
+class LmdbBackend(object):
+    def __init__(self, path):
+        self.path = path
+        self.env = None
+        self.blobs = None
+
+    def _open(self):
+        self.env = lmdb.open(
+            self.path,
+            subdir=os.path.isdir(self.path),
+            readonly=True,
+            lock=False,
+            readahead=False,
+            meminit=False,
+        )
+        # one long-lived read transaction per worker: records are returned as
+        # memoryviews into the LMDB map, which stay valid while it is open
+        self.txn = self.env.begin(write=False, buffers=True)
+        self.keys = read_keys(self.txn)
+        blobs = self.txn.get(BLOBS_KEY)
+        if blobs is not None:
+            # relative to the directory holding the lmdb, as written by
+            # tools/folder2lmdb.py; "x.lmdb/" or "x.lmdb" alone resolve too
+            root = os.path.dirname(os.path.abspath(self.path.rstrip(os.sep)))
+            self.blobs = open_blob_store(
+                os.path.join(root, bytes(blobs).decode("utf-8"))
+            )
+
+    @property
+    def is_open(self):
+        return self.env is not None
+
+    def __len__(self):
+        if self.env is None:
+            self._open()
+        return len(self.keys)
+
+    def get(self, index):
+        # Delay loading LMDB data until after initialization: https://github.com/chainer/chainermn/issues/129
+        if self.env is None:
+            self._open()
+        return loads_record(self.txn.get(self.keys[index]), self.blobs)
+
+    def reader(self):
+        """Copy of the backend with its own read transactions, to read the
+        same environment from another thread."""
+        if self.env is None:
+            self._open()
+        reader = copy.copy(self)
+        reader.txn = self.env.begin(write=False, buffers=True)
+        if self.blobs is not None:
+            reader.blobs = copy.copy(self.blobs)
+            reader.blobs.txn = self.blobs.env.begin(write=False, buffers=True)
+        return reader
+
+    def release(self):
+        """End the read transactions of a `reader` copy, the environment
+        stays open for the backend it was copied from."""
+        self.txn.abort()
+        if self.blobs is not None:
+            self.blobs.txn.abort()
+
+    def close(self):
+        # an environment left open in the main process makes workers forked
+        # later fail to open the same path
+        if self.env is not None:
+            if self.blobs is not None:
+                close_blob_store(self.blobs)
+                self.blobs = None
+            self.txn.abort()
+            self.env.close()
+            self.env = None
+
+
+class ShardRecord(object):
+    def __init__(self, img, mask, meta, tokens=None):
+        self.img = img
+        self.mask = mask
+        self.meta = meta
+        self.tokens = tokens
+
+    def token_rows(self):
+        return self.tokens.reshape(-1, self.meta["tokens"]["word_len"])
+
+    def __getitem__(self, key):
+        if key == "img":
+            return self.img
+        if key == "mask":
+            return self.mask
+        return self.meta[key]
+
+    def __contains__(self, key):
+        return key in ("img", "mask") or key in self.meta
+
+
+class ShardBackend(object):
+    """
+    Contiguous memory-mapped shards: `images.bin` and `masks.bin` hold the
+    encoded files back to back, `tokens.bin` the int32 pre-tokenized prompts,
+    `offsets.npy` is an int64 [N, 6] index of (img offset, img length, mask
+    offset, mask length, token offset, token count) and `prompts.json` the
+    per-sample meta. Reads are plain slices of the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = None
+
+    def _open(self):
+        self.images = np.memmap(
+            os.path.join(self.path, SHARD_IMAGES), dtype=np.uint8, mode="r"
+        )
+        self.masks = np.memmap(
+            os.path.join(self.path, SHARD_MASKS), dtype=np.uint8, mode="r"
+        )
+        self.offsets = np.load(os.path.join(self.path, SHARD_OFFSETS))
+        tokens = os.path.join(self.path, SHARD_TOKENS)
+        self.tokens = (
+            np.memmap(tokens, dtype=np.int32, mode="r")
+            if os.path.getsize(tokens) > 0
+            else None
+        )
+        with open(os.path.join(self.path, SHARD_PROMPTS), "r") as f:
+            self.metas = json.load(f)
+
+    @property
+    def is_open(self):
+        return self.offsets is not None
+
+    def __len__(self):
+        if self.offsets is None:
+            self._open()
+        return len(self.offsets)
+
+    def get(self, index):
+        if self.offsets is None:
+            self._open()
+        img_off, img_len, mask_off, mask_len, tok_off, tok_len = self.offsets[index]
+        return ShardRecord(
+            self.images[img_off : img_off + img_len],
+            self.masks[mask_off : mask_off + mask_len],
+            self.metas[index],
+            self.tokens[tok_off : tok_off + tok_len] if tok_len else None,
+        )
+
+    def reader(self):
+        if self.offsets is None:
+            self._open()
+        return self
+
+    def close(self):
+        self.offsets = None
+        self.images = self.masks = self.tokens = self.metas = None
+
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _madvise = _libc.madvise
+    _madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+except (AttributeError, OSError):
+    _madvise = None
+MADV_WILLNEED = 3
+
+
+def advise(buf):
+    """Ask the kernel to start reading the pages of a mapped buffer
+    (madvise WILLNEED, the call drops the GIL). Without madvise the pages
+    are touched instead."""
+    arr = np.frombuffer(buf, np.uint8)
+    if arr.size == 0:
+        return
+    if _madvise is not None:
+        addr = arr.ctypes.data
+        start = addr - addr % mmap.PAGESIZE
+        _madvise(start, addr + arr.size - start, MADV_WILLNEED)
+    else:
+        int(arr[:: mmap.PAGESIZE].sum())
+
+
+def touch(buf):
+    """Fault in every page of a buffer, returns nothing useful."""
+    arr = np.frombuffer(buf, np.uint8)
+    return int(arr[:: mmap.PAGESIZE].sum())
+
+
+class Prefetcher(object):
+    """
+    Background thread of a DataLoader worker that advises the pages of the
+    records it will read next, following the sampler order given as `order`
+    (the indices of this worker, in the order they will be requested).
+
+    `get` replaces `backend.get` in the worker and records into `stats`
+    (a shared [3] float64 tensor row): records read, records that had
+    already been prefetched, and seconds spent faulting in record pages.
+    """
+
+    def __init__(self, backend, order, depth, stats):
+        self.backend = backend
+        self.reader = backend.reader()
+        self.order = order
+        self.position = {index: pos for pos, index in enumerate(order)}
+        self.depth = depth
+        self.stats = stats
+        self.cursor = -1
+        self.advised = -1
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        reader = self.reader
+        last = len(self.order) - 1
+        while True:
+            with self.cond:
+                while self.advised >= min(self.cursor + self.depth, last):
+                    if self.advised >= last or self.stopped:
+                        return
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                pos = self.advised + 1
+            ref = reader.get(self.order[pos])
+            advise(ref["img"])
+            advise(ref["mask"])
+            self.advised = pos
+
+    def get(self, index):
+        pos = self.position.get(index)
+        if pos is not None:
+            with self.cond:
+                self.cursor = max(self.cursor, pos)
+                self.cond.notify()
+        hit = pos is not None and pos <= self.advised
+        start = time.perf_counter()
+        ref = self.backend.get(index)
+        touch(ref["img"])
+        touch(ref["mask"])
+        self.stats[0] += 1
+        self.stats[1] += hit
+        self.stats[2] += time.perf_counter() - start
+        return ref
+
+    def stop(self):
+        """Stop the thread and end the read transactions of its reader."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+        if self.reader is not self.backend:
+            self.reader.release()
+
+
+def write_shards(records, path):
+    """
+    Write an iterable of records (anything indexable like `LmdbBackend.get`)
+    as a shard directory. Identical images are written once and shared
+    through the offsets. Returns the number of records written.
+    """
+    os.makedirs(path, exist_ok=True)
+    offsets = []
+    metas = []
+    images = {}
+    img_pos = mask_pos = tok_pos = 0
+    with open(os.path.join(path, SHARD_IMAGES), "wb") as fi, open(
+        os.path.join(path, SHARD_MASKS), "wb"
+    ) as fm, open(os.path.join(path, SHARD_TOKENS), "wb") as ft:
+        for ref in records:
+            img, mask = ref["img"], ref["mask"]
+            key = blob_key(img)
+            if key not in images:
+                images[key] = img_pos
+                fi.write(img)
+                img_pos += len(img)
+            fm.write(mask)
+            meta = {
+                "mask_name": ref["mask_name"],
+                "img_name": ref["img_name"],
+                "prompts": ref["prompts"],
+            }
+            tok_len = 0
+            if "tokens" in ref:
+                meta["tokens"] = ref["tokens"]
+                tokens = np.ascontiguousarray(ref.token_rows(), dtype=np.int32)
+                ft.write(tokens.tobytes())
+                tok_len = tokens.size
+            offsets.append(
+                (images[key], len(img), mask_pos, len(mask), tok_pos, tok_len)
+            )
+            mask_pos += len(mask)
+            tok_pos += tok_len
+            metas.append(meta)
+    np.save(
+        os.path.join(path, SHARD_OFFSETS),
+        np.array(offsets, dtype=np.int64).reshape(-1, 6),
+    )
+    with open(os.path.join(path, SHARD_PROMPTS), "w") as f:
+        json.dump(metas, f)
+    return len(offsets)
+
+
+backends = {
+    "lmdb": LmdbBackend,
+    "shard": ShardBackend,
+}
+
+
+def build_backend(kind, path):
+    assert kind in backends, "unknown storage backend {}, one of {}".format(
+        kind, list(backends)
+    )
+    return backends[kind](path)